@@ -16,8 +16,15 @@ Last Updated: 2024-11-15
 
 import sys
 import subprocess
+from importlib.metadata import version, PackageNotFoundError
 
 def install_new_ragas():
+    # Skip pip when the pinned version is already installed, it takes several seconds per run
+    try:
+        if version("ragas") == "0.2.5":
+            return
+    except PackageNotFoundError:
+        pass
     subprocess.check_call(
         [sys.executable, "-m", "pip", "install", "ragas==0.2.5"],
         stdout=subprocess.DEVNULL,  # Suppresses standard output
@@ -36,24 +43,107 @@ from ragas.metrics import (
     answer_relevancy,  # Is answer addressing the question? - LLM output evaluation
 )
 
-# Import datasets for RAGAS evaluation
-from datasets import Dataset
-import pandas as pd
+from ragas.prompt import pydantic_prompt
+import json_repair
 
-# LangChain imports
-from langchain_openai import OpenAIEmbeddings, ChatOpenAI
+# Import datasets for RAGAS evaluation
+from datasets import Dataset, Features, Sequence, Value
 
 # Other imports
-from main import generate_safety_plan
-from datetime import datetime
+from main import agenerate_safety_plan, generate_safety_plan, ANALYSIS_MODEL, PLAN_MODEL, SINGLE_PASS, FULL_EXAMPLES, HTTP_CLIENT
+from main import (
+    BGE_MODEL_NAME, EMBEDDING_DIMENSIONS, EMBEDDING_MODEL, FAISS_INDEX_PATH, MAX_RETRIEVED_SOURCES,
+    NEIGHBOURHOOD_MATCH_THRESHOLD, PINECONE_INDEX_NAME, PLAN_OUTPUT_FORMAT, PROMPT_TOKEN_BUDGET, RERANK_FETCH_K,
+    RERANK_MODEL, RERANK_TOP_N, RETRIEVED_CONTEXT_TOKENS, RETRIEVER_PER_CONCERN, RETRIEVER_SEARCH_KWARGS, RETRIEVER_SEARCH_TYPE,
+    SEMANTIC_CACHE_THRESHOLD, STATIC_PROMPT_TEXTS
+)
+from langchain_core.tracers.langchain import wait_for_all_tracers
+from langchain_community.callbacks import get_openai_callback
+from evals_embedding_cache import CachedOpenAIEmbeddings
+from evals_answer_cache import AnswerCache
+from evals_batch_llm import BatchAPILLM
+from evals_consolidated_judge import judge_samples
+from ragas.run_config import RunConfig
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from tqdm import tqdm
 import os
 from dotenv import load_dotenv
 import json
+import orjson
+from functools import lru_cache
 from pathlib import Path
+import logging
 
 # Load environment variables
 load_dotenv(".env", override=True)
 
+# Set up logging
+logging.basicConfig(level=logging.INFO, format='%(message)s')
+logger = logging.getLogger(__name__)
+
+# Judge LLMs sometimes answer with almost-JSON (trailing commas, single quotes, a missing brace),
+# which RAGAS scores as NaN. Repair it before RAGAS parses it, RAGAS's own fix-the-format retry stays as the fallback
+extract_ragas_json = pydantic_prompt.extract_json
+
+def extract_repaired_json(text: str) -> str:
+    """RAGAS's extract_json, with a json_repair pass when the extracted text is not valid JSON."""
+    extracted = extract_ragas_json(text)
+    try:
+        json.loads(extracted)
+        return extracted
+    except json.JSONDecodeError:
+        return json_repair.repair_json(text) or extracted
+
+pydantic_prompt.extract_json = extract_repaired_json
+
+# Column types of the RAGAS dataset, declared so Arrow does not infer them from every row
+RAGAS_FEATURES = Features({
+    "question": Value("string"),
+    "answer": Value("string"),
+    "contexts": Sequence(Value("string")),
+    "ground_truths": Sequence(Value("string")),
+    "reference": Value("string")
+})
+
+# Score columns that must be filled for every sample
+SCORE_COLUMNS = ("faithfulness", "answer_relevancy", "context_precision", "context_recall")
+
+# Embedding model for answer_relevancy, cached on disk across runs. The metric only compares cosine similarities,
+# so the small model truncated to 512 dimensions is enough, at a fraction of the cost of the RAGAS default (ada-002).
+EVAL_EMBEDDING_MODEL = "text-embedding-3-small"
+EVAL_EMBEDDING_DIMENSIONS = 512
+
+# Set RAGAS_USE_BATCH_API=1 to send the RAGAS judge calls through the OpenAI Batch API (half price, results within 24h).
+# Judge model is the RAGAS default; every sample runs at once so each metric step fits in one batch.
+RAGAS_USE_BATCH_API = os.getenv("RAGAS_USE_BATCH_API", "").lower() in ("1", "true", "yes")
+EVAL_JUDGE_MODEL = "gpt-4o-mini"
+BATCH_RUN_CONFIG = RunConfig(timeout=24 * 60 * 60, max_workers=1024)
+
+# Set EVAL_CONSOLIDATED_JUDGE=1 to score faithfulness, answer relevancy, context precision and context recall
+# with one judge call per sample instead of the multi-call RAGAS metrics
+EVAL_CONSOLIDATED_JUDGE = os.getenv("EVAL_CONSOLIDATED_JUDGE", "").lower() in ("1", "true", "yes")
+
+# Set EVAL_USE_RETRIEVED_CONTEXTS=1 to score against the documents the generator retrieved for each plan,
+# returned with the plan, instead of the test set's ground truth contexts
+EVAL_USE_RETRIEVED_CONTEXTS = os.getenv("EVAL_USE_RETRIEVED_CONTEXTS", "").lower() in ("1", "true", "yes")
+
+# Safety plans generated at once; the OpenAI rate limiter in main.py still applies on top
+EVAL_MAX_CONCURRENCY = int(os.getenv("EVAL_MAX_CONCURRENCY", "8"))
+
+# Warn when the slowest 5% of plans take longer than this to generate
+GEN_LATENCY_WARNING_SECONDS = 10
+
+# Set EVAL_ANSWER_CACHE=1 to reuse the safety plans of an earlier run with the same RAG configuration,
+# e.g. while tuning the judge; their latency and token columns are those of the run that generated them
+EVAL_ANSWER_CACHE = os.getenv("EVAL_ANSWER_CACHE", "").lower() in ("1", "true", "yes")
+
+# Set EVAL_USE_THREADS=1 to generate with the synchronous generator in a thread pool instead of on an event loop
+EVAL_USE_THREADS = os.getenv("EVAL_USE_THREADS", "").lower() in ("1", "true", "yes")
+
+# Parsed once per process and file; callers only read the test cases
+@lru_cache(maxsize=4)
 def load_test_set(filename: str = None):
     """Load test questions from JSON file"""
     test_sets_dir = Path("test_sets")
@@ -65,10 +155,115 @@ def load_test_set(filename: str = None):
         latest_test_set = max(test_sets, key=lambda x: x.stat().st_mtime)
         filename = latest_test_set.name
     
-    with open(test_sets_dir / filename) as f:
-        test_set = json.load(f)
+    with open(test_sets_dir / filename, "rb") as f:
+        test_set = orjson.loads(f.read())
     return test_set["questions"]
 
+def rag_config_fingerprint() -> str:
+    """
+    Everything in main.py that changes the generated plans: models, prompts (with examples), retriever,
+    neighbourhood matching, the semantic plan cache and the prompt budget.
+    """
+    return repr([
+        ANALYSIS_MODEL, PLAN_MODEL, SINGLE_PASS, PLAN_OUTPUT_FORMAT,
+        EMBEDDING_MODEL, EMBEDDING_DIMENSIONS, PINECONE_INDEX_NAME, FAISS_INDEX_PATH,
+        os.getenv("PINECONE_BGE_INDEX_NAME"), BGE_MODEL_NAME,
+        RETRIEVER_SEARCH_TYPE, RETRIEVER_SEARCH_KWARGS, RERANK_MODEL, RERANK_FETCH_K, RERANK_TOP_N,
+        RETRIEVER_PER_CONCERN, MAX_RETRIEVED_SOURCES,
+        NEIGHBOURHOOD_MATCH_THRESHOLD, SEMANTIC_CACHE_THRESHOLD, PROMPT_TOKEN_BUDGET, RETRIEVED_CONTEXT_TOKENS,
+        STATIC_PROMPT_TEXTS
+    ])
+
+def validate_test_cases(test_cases) -> None:
+    """Raise ValueError listing every malformed test case, before any OpenAI call is made."""
+    problems = []
+    for i, test_case in enumerate(test_cases, 1):
+        if not isinstance(test_case, dict):
+            problems.append(f"question {i}: not an object")
+            continue
+        if not isinstance(test_case.get("question"), str) or not test_case["question"].strip():
+            problems.append(f"question {i}: missing question text")
+        if not isinstance(test_case.get("ground_truth_context"), list):
+            problems.append(f"question {i}: ground_truth_context must be a list")
+        if "ground_truth" not in test_case:
+            problems.append(f"question {i}: missing ground_truth")
+        structured_input = test_case.get("metadata", {}).get("structured_input")
+        if not isinstance(structured_input, dict):
+            problems.append(f"question {i}: missing metadata.structured_input")
+            continue
+        for key in ("neighbourhood", "crime_type", "user_context"):
+            if key not in structured_input:
+                problems.append(f"question {i}: structured_input missing {key}")
+    if problems:
+        raise ValueError("Malformed test set:\n" + "\n".join(problems))
+
+def generation_stats(start: float, usage) -> dict:
+    """Latency and OpenAI token usage of one safety plan generation."""
+    return {
+        "gen_latency_s": time.perf_counter() - start,
+        "prompt_tokens": usage.prompt_tokens,
+        "completion_tokens": usage.completion_tokens
+    }
+
+async def generate_answers(test_cases):
+    """
+    Generate the safety plan for every test case, at most EVAL_MAX_CONCURRENCY at once, in test case order.
+    
+    Each answer is a (SafetyPlan, generation_stats) pair, or the exception raised for that test case.
+    """
+    semaphore = asyncio.Semaphore(EVAL_MAX_CONCURRENCY)
+    
+    progress = tqdm(total=len(test_cases), desc="Generating safety plans")
+    
+    async def generate_answer(test_case):
+        try:
+            structured_input = test_case["metadata"]["structured_input"]
+            async with semaphore:
+                with get_openai_callback() as usage:
+                    start = time.perf_counter()
+                    safety_plan = await agenerate_safety_plan(
+                        neighbourhood=structured_input["neighbourhood"],
+                        crime_type=structured_input["crime_type"],
+                        user_context=structured_input["user_context"],
+                        structured=True
+                    )
+                    return safety_plan, generation_stats(start, usage)
+        finally:
+            progress.update()
+    
+    with progress:
+        return await asyncio.gather(*(generate_answer(test_case) for test_case in test_cases), return_exceptions=True)
+
+def generate_answers_threaded(test_cases):
+    """Thread pool version of generate_answers, with the same results in test case order."""
+    def generate_answer(test_case):
+        structured_input = test_case["metadata"]["structured_input"]
+        with get_openai_callback() as usage:
+            start = time.perf_counter()
+            safety_plan = generate_safety_plan(
+                neighbourhood=structured_input["neighbourhood"],
+                crime_type=structured_input["crime_type"],
+                user_context=structured_input["user_context"],
+                structured=True
+            )
+            return safety_plan, generation_stats(start, usage)
+    
+    answers = [None] * len(test_cases)
+    with ThreadPoolExecutor(max_workers=EVAL_MAX_CONCURRENCY) as executor:
+        futures = {executor.submit(generate_answer, test_case): i for i, test_case in enumerate(test_cases)}
+        for future in tqdm(as_completed(futures), total=len(futures), desc="Generating safety plans"):
+            try:
+                answers[futures[future]] = future.result()
+            except Exception as error:
+                answers[futures[future]] = error
+    return answers
+
+def batch_api_settings():
+    """Extra evaluate() arguments when the judge calls go through the OpenAI Batch API."""
+    if not RAGAS_USE_BATCH_API:
+        return {}
+    return {"llm": BatchAPILLM(model=EVAL_JUDGE_MODEL), "run_config": BATCH_RUN_CONFIG}
+
 def run_rag_evaluation():
     """Run RAGAS evaluation on the RAG pipeline and save generated answers"""
     print("Starting LLM Output evaluation...")
@@ -77,6 +272,9 @@ def run_rag_evaluation():
     test_cases = load_test_set()
     total_cases = len(test_cases)
     
+    # A malformed test set would otherwise only show up as one failed question after another
+    validate_test_cases(test_cases)
+    
     # Prepare results in RAGAS format
     results = {
         "question": [],
@@ -89,44 +287,113 @@ def run_rag_evaluation():
     # Store generated answers for reuse
     generated_answers = {}
     
-    for i, test_case in enumerate(test_cases, 1):
-        print(f"\nProcessing question {i}/{total_cases}")
-        try:
-            structured_input = test_case["metadata"]["structured_input"]
-            
-            print(f"Generating safety plan for {structured_input['neighbourhood']}...")
-            # Generate answer using the safety plan generator
-            result = generate_safety_plan(
-                neighbourhood=structured_input["neighbourhood"],
-                crime_type=structured_input["crime_type"],
-                user_context=structured_input["user_context"]
+    structured_inputs = [test_case["metadata"]["structured_input"] for test_case in test_cases]
+    answer_cache = AnswerCache(rag_config_fingerprint()) if EVAL_ANSWER_CACHE else None
+    answers = answer_cache.lookup(structured_inputs) if answer_cache else {}
+    missing = [i for i in range(total_cases) if i not in answers]
+    
+    # Generate every missing safety plan concurrently, failures are returned in place of the plan
+    logger.info(
+        "Generating %d safety plans (%d cached), %d at a time",
+        len(missing), total_cases - len(missing), EVAL_MAX_CONCURRENCY
+    )
+    missing_cases = [test_cases[i] for i in missing]
+    if EVAL_USE_THREADS:
+        generated = generate_answers_threaded(missing_cases)
+    else:
+        generated = asyncio.run(generate_answers(missing_cases))
+    
+    for i, answer in zip(missing, generated):
+        answers[i] = answer
+        if answer_cache and not isinstance(answer, Exception):
+            answer_cache.store(structured_inputs[i], *answer)
+    answers = [answers[i] for i in range(total_cases)]
+    
+    # Generation latency and token usage of each answered question, in results order
+    stats = []
+    
+    for i, (test_case, answer) in enumerate(zip(test_cases, answers), 1):
+        # KeyError/TypeError are bugs, not a flaky API call, so stop instead of skipping every question
+        if isinstance(answer, (KeyError, TypeError)):
+            raise answer
+        if isinstance(answer, Exception):
+            logger.error(
+                "Error processing question %d, structured input was: %s",
+                i, test_case.get("metadata", {}).get("structured_input"),
+                exc_info=answer
             )
-            
-            print(f"Safety plan generated, formatting results...")
-            # Store the generated answer with question as key
-            generated_answers[test_case["question"]] = result
-            
-            # Format for RAGAS evaluation
-            results["question"].append(test_case["question"])
-            results["answer"].append(result)
-            results["contexts"].append(test_case["ground_truth_context"])
-            results["ground_truths"].append(test_case["ground_truth"])
-            results["reference"].append(" ".join(test_case["ground_truth_context"]))
-            
-            print(f"Question {i} completed successfully")
-            
-        except Exception as e:
-            print(f"Error processing question {i}: {str(e)}")
-            print(f"Structured input was: {structured_input}")
             continue
+        safety_plan, plan_stats = answer
+        stats.append(plan_stats)
+        result = str(safety_plan)
+        
+        # Store the generated answer with question as key
+        generated_answers[test_case["question"]] = result
+        
+        # Format for RAGAS evaluation
+        results["question"].append(test_case["question"])
+        results["answer"].append(result)
+        if EVAL_USE_RETRIEVED_CONTEXTS:
+            results["contexts"].append(safety_plan.contexts)
+        else:
+            results["contexts"].append(test_case["ground_truth_context"])
+        results["ground_truths"].append(test_case["ground_truth"])
+        results["reference"].append(" ".join(test_case["ground_truth_context"]))
+    
+    print(f"{len(results['answer'])}/{total_cases} questions completed successfully")
+    
+    # LangSmith traces are sent in the background, flush them before the long RAGAS step
+    wait_for_all_tracers()
     
     print("\nSaving generated answers...")
     # Save generated answers to file
     with open('generated_answers.json', 'w') as f:
         json.dump(generated_answers, f, indent=2)
     
+    # Time the scoring separately, to see whether generation or the judge calls dominate
+    scoring_start = time.perf_counter()
+    rag_results = score_results(results)
+    logger.info("Scoring took %.1fs", time.perf_counter() - scoring_start)
+    
+    for column in ("gen_latency_s", "prompt_tokens", "completion_tokens"):
+        rag_results[column] = [plan_stats[column] for plan_stats in stats]
+    
+    p95_latency = rag_results["gen_latency_s"].quantile(0.95)
+    logger.info("Generation latency p50 %.1fs, p95 %.1fs", rag_results["gen_latency_s"].median(), p95_latency)
+    if p95_latency > GEN_LATENCY_WARNING_SECONDS:
+        logger.warning("p95 generation latency is above %ds", GEN_LATENCY_WARNING_SECONDS)
+    
+    return rag_results
+
+def score_results(results):
+    """Score the generated answers with RAGAS, or the consolidated judge when EVAL_CONSOLIDATED_JUDGE is set."""
+    if EVAL_CONSOLIDATED_JUDGE:
+        print("\nScoring with the consolidated judge...")
+        return judge_samples(
+            questions=results["question"],
+            answers=results["answer"],
+            contexts=results["contexts"],
+            references=[
+                " ".join(ground_truth) if isinstance(ground_truth, list) else ground_truth
+                for ground_truth in results["ground_truths"]
+            ],
+            model=EVAL_JUDGE_MODEL,
+            concurrency=EVAL_MAX_CONCURRENCY
+        )
+    
     print("\nCreating RAGAS dataset...")
-    eval_data = Dataset.from_dict(results)
+    eval_data = Dataset.from_dict(results, features=RAGAS_FEATURES)
+    
+    # answer_relevancy embeds every question; embed the distinct ones in one batched call up front,
+    # so RAGAS's one-at-a-time embedding calls are all cache hits
+    # Sync calls share main.py's HTTP/2 pool (also used by EVAL_USE_THREADS generation) instead of opening another.
+    # The async client is left to RAGAS, since an httpx pool cannot be shared across event loops
+    embeddings = CachedOpenAIEmbeddings(
+        model=EVAL_EMBEDDING_MODEL,
+        dimensions=EVAL_EMBEDDING_DIMENSIONS,
+        http_client=HTTP_CLIENT
+    )
+    embeddings.embed_documents(list(dict.fromkeys(results["question"])))
     
     print("\nStarting RAGAS evaluation...")
     try:
@@ -136,7 +403,9 @@ def run_rag_evaluation():
             metrics=[
                 faithfulness,
                 answer_relevancy
-            ]
+            ],
+            embeddings=embeddings,
+            **batch_api_settings()
         )
         print("RAGAS evaluation completed successfully")
         return scores.to_pandas()
@@ -154,7 +423,25 @@ if __name__ == "__main__":
     print("\nEvaluating RAG Pipeline...")
     rag_results = run_rag_evaluation()
     
+    # Record the models and chain used, so runs with different ANALYSIS_MODEL / PLAN_MODEL
+    # or SAFETY_PLAN_SINGLE_PASS / SAFETY_PLAN_FULL_EXAMPLES settings can be compared
+    rag_results["analysis_model"] = ANALYSIS_MODEL
+    rag_results["plan_model"] = PLAN_MODEL
+    rag_results["single_pass"] = SINGLE_PASS
+    rag_results["full_examples"] = FULL_EXAMPLES
+    rag_results["use_retrieved_contexts"] = EVAL_USE_RETRIEVED_CONTEXTS
+    rag_results["eval_embedding_model"] = f"{EVAL_EMBEDDING_MODEL}-{EVAL_EMBEDDING_DIMENSIONS}"
+    
     # Export results to CSV:
     rag_results.to_csv('rag_results.csv', index=False)
     
+    # A NaN score is a judge call that failed to parse, and would silently be dropped from the averages
+    score_columns = [column for column in SCORE_COLUMNS if column in rag_results]
+    missing_scores = rag_results[score_columns].isna().any(axis=1)
+    if missing_scores.any():
+        raise RuntimeError(
+            f"{missing_scores.sum()} of {len(rag_results)} samples have NaN scores, see rag_results.csv: "
+            f"{rag_results.loc[missing_scores, 'user_input'].tolist()}"
+        )
+    
     print("\nEvaluation complete!")
\ No newline at end of file
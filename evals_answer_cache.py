@@ -0,0 +1,73 @@
+"""
+evals_answer_cache.py
+Goal: Persistent cache of generated safety plans, for re-running the evaluation without regenerating them.
+
+While tuning the judge or the metrics, the RAG pipeline does not change between runs, so neither do its answers.
+Plans are stored in a SQLite file keyed by a SHA-256 digest of a fingerprint of the RAG configuration and the
+structured input, so any change to the models, prompts or retriever makes every question a miss.
+"""
+
+import hashlib
+import json
+import sqlite3
+from typing import Dict, List, Tuple
+
+from main import SafetyPlan
+
+# SQLite file holding the cached plans
+ANSWER_CACHE_PATH = "answer_cache.sqlite"
+
+class AnswerCache:
+    """Generated SafetyPlans and their generation stats, by RAG configuration and structured input."""
+
+    def __init__(self, config_fingerprint: str, cache_path: str = ANSWER_CACHE_PATH):
+        self.config_fingerprint = config_fingerprint
+        self.connection = sqlite3.connect(cache_path)
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS answers (hash BLOB PRIMARY KEY, plan TEXT, stats TEXT)"
+        )
+
+    def cache_key(self, structured_input: Dict) -> bytes:
+        """SHA-256 of the configuration fingerprint and the structured input, with keys sorted."""
+        payload = json.dumps(structured_input, sort_keys=True)
+        return hashlib.sha256(f"{self.config_fingerprint}\x00{payload}".encode("utf-8")).digest()
+
+    def lookup(self, structured_inputs: List[Dict]) -> Dict[int, Tuple[SafetyPlan, Dict]]:
+        """(SafetyPlan, generation stats) of every cached input, by position in structured_inputs."""
+        found = {}
+        for i, structured_input in enumerate(structured_inputs):
+            row = self.connection.execute(
+                "SELECT plan, stats FROM answers WHERE hash = ?", (self.cache_key(structured_input),)
+            ).fetchone()
+            if row is None:
+                continue
+            plan = json.loads(row[0])
+            found[i] = (
+                SafetyPlan(
+                    neighbourhood=plan["neighbourhood"],
+                    primary_concerns=plan["primary_concerns"],
+                    body=plan["body"],
+                    sources=[tuple(source) for source in plan["sources"]],
+                    contexts=plan["contexts"]
+                ),
+                json.loads(row[1])
+            )
+        return found
+
+    def store(self, structured_input: Dict, safety_plan: SafetyPlan, stats: Dict) -> None:
+        """Write a freshly generated plan and its generation stats."""
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO answers (hash, plan, stats) VALUES (?, ?, ?)",
+                (
+                    self.cache_key(structured_input),
+                    json.dumps({
+                        "neighbourhood": safety_plan.neighbourhood,
+                        "primary_concerns": safety_plan.primary_concerns,
+                        "body": safety_plan.body,
+                        "sources": safety_plan.sources,
+                        "contexts": safety_plan.contexts
+                    }),
+                    json.dumps(stats)
+                )
+            )
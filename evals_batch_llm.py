@@ -0,0 +1,123 @@
+"""
+evals_batch_llm.py
+Goal: RAGAS judge LLM that sends its calls through the OpenAI Batch API, at half the price of regular calls.
+
+The evaluation is offline, so judge calls can wait for a batch instead of being answered one by one.
+Prompts requested by RAGAS are queued; once no new prompt has arrived for collect_seconds, the queue is uploaded
+as one batch, polled until it completes, and every waiting prompt gets its response.
+Used by evals_LLMOutput_V3.py when RAGAS_USE_BATCH_API=1. Written for RAGAS 0.2.5.
+"""
+
+import asyncio
+import json
+from dataclasses import dataclass, field
+from typing import Dict, List, Tuple
+
+from langchain_core.outputs import Generation, LLMResult
+from langchain_core.prompt_values import PromptValue
+from openai import AsyncOpenAI
+from ragas.llms import BaseRagasLLM
+
+# LangChain message types to OpenAI chat roles
+MESSAGE_ROLES = {"system": "system", "human": "user", "ai": "assistant"}
+
+# Batch states after which the batch will not change anymore
+FINAL_BATCH_STATES = ("completed", "failed", "expired", "cancelled")
+
+@dataclass
+class BatchAPILLM(BaseRagasLLM):
+    """BaseRagasLLM answering every queued prompt with one OpenAI Batch API job."""
+
+    model: str = "gpt-4o-mini"
+    collect_seconds: float = 5.0
+    poll_seconds: float = 30.0
+
+    pending: List[Tuple[Dict, asyncio.Future]] = field(default_factory=list, init=False, repr=False)
+    flush_task: asyncio.Task = field(default=None, init=False, repr=False)
+
+    def __post_init__(self):
+        self.client = AsyncOpenAI()
+
+    def is_finished(self, response: LLMResult) -> bool:
+        return True
+
+    def generate_text(self, prompt: PromptValue, n: int = 1, temperature: float = 1e-8, stop=None, callbacks=None) -> LLMResult:
+        return asyncio.run(self.agenerate_text(prompt, n=n, temperature=temperature, stop=stop, callbacks=callbacks))
+
+    async def agenerate_text(self, prompt: PromptValue, n: int = 1, temperature: float = None, stop=None, callbacks=None) -> LLMResult:
+        """Queue the prompt for the next batch and wait for its completions."""
+        body = {
+            "model": self.model,
+            "messages": [
+                {"role": MESSAGE_ROLES.get(message.type, "user"), "content": message.content}
+                for message in prompt.to_messages()
+            ],
+            "n": n,
+            "temperature": self.get_temperature(n) if temperature is None else temperature
+        }
+        if stop:
+            body["stop"] = stop
+
+        future = asyncio.get_running_loop().create_future()
+        self.pending.append((body, future))
+
+        # Restart the collection window, so the batch is sent once RAGAS stops adding prompts
+        if self.flush_task is not None and not self.flush_task.done():
+            self.flush_task.cancel()
+        self.flush_task = asyncio.create_task(self.flush_after_window())
+
+        texts = await future
+        return LLMResult(generations=[[Generation(text=text) for text in texts]])
+
+    async def flush_after_window(self) -> None:
+        await asyncio.sleep(self.collect_seconds)
+        # Sending the batch must not be cancelled by a prompt arriving meanwhile
+        await asyncio.shield(self.flush())
+
+    async def flush(self) -> None:
+        """Send the queued prompts as one batch and resolve their futures with the responses."""
+        queued, self.pending = self.pending, []
+        if not queued:
+            return
+        try:
+            results = await self.run_batch([body for body, _ in queued])
+        except Exception as error:
+            for _, future in queued:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        for i, (_, future) in enumerate(queued):
+            result = results.get(str(i))
+            if result is None or result.get("error") or result["response"]["status_code"] != 200:
+                future.set_exception(RuntimeError(f"Batch request {i} failed: {result}"))
+            else:
+                future.set_result([choice["message"]["content"] for choice in result["response"]["body"]["choices"]])
+
+    async def run_batch(self, bodies: List[Dict]) -> Dict[str, Dict]:
+        """Upload the requests, wait for the batch to finish and return the output lines by custom_id."""
+        requests = "\n".join(
+            json.dumps({"custom_id": str(i), "method": "POST", "url": "/v1/chat/completions", "body": body})
+            for i, body in enumerate(bodies)
+        )
+        input_file = await self.client.files.create(
+            file=("ragas_judge_batch.jsonl", requests.encode("utf-8")),
+            purpose="batch"
+        )
+        batch = await self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h"
+        )
+        print(f"Submitted {len(bodies)} judge calls as OpenAI batch {batch.id}")
+
+        while batch.status not in FINAL_BATCH_STATES:
+            await asyncio.sleep(self.poll_seconds)
+            batch = await self.client.batches.retrieve(batch.id)
+
+        if batch.status != "completed" or not batch.output_file_id:
+            raise RuntimeError(f"OpenAI batch {batch.id} ended with status {batch.status}")
+
+        output = await self.client.files.content(batch.output_file_id)
+        lines = [json.loads(line) for line in output.text.splitlines() if line.strip()]
+        return {line["custom_id"]: line for line in lines}
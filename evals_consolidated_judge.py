@@ -0,0 +1,92 @@
+"""
+evals_consolidated_judge.py
+Goal: Score faithfulness, answer relevancy, context precision and context recall with one judge LLM call per sample.
+
+RAGAS runs several LLM calls per sample and metric (statement extraction, verdicts, generated questions, ...).
+This judge inlines a rubric for each of the four metrics in one prompt and asks for all four scores as a JSON object,
+which costs a fraction of the judge tokens. Scores are not numerically identical to RAGAS, so compare runs scored the same way.
+Used by evals_LLMOutput_V3.py when EVAL_CONSOLIDATED_JUDGE=1.
+"""
+
+from typing import List
+
+import pandas as pd
+from langchain_core.prompts import ChatPromptTemplate
+from langchain_openai import ChatOpenAI
+from pydantic import BaseModel, Field
+
+class JudgeScores(BaseModel):
+    """The four RAG quality scores for one sample, each between 0 and 1."""
+    faithfulness: float = Field(description="Share of the answer's claims supported by the contexts, 0 to 1")
+    answer_relevancy: float = Field(description="How directly and completely the answer addresses the question, 0 to 1")
+    context_precision: float = Field(description="Share of the contexts that are relevant to the reference, weighted towards the first ones, 0 to 1")
+    context_recall: float = Field(description="Share of the reference's claims that the contexts support, 0 to 1")
+
+JUDGE_SYSTEM_PROMPT = """
+    You are evaluating the output of a retrieval-augmented safety plan generator. Score each metric from 0 to 1:
+
+    - faithfulness: Break the answer into its factual claims. Score the fraction of claims that can be inferred from the contexts.
+    - answer_relevancy: Score how directly the answer addresses the question. Penalize missing parts of the question and off-topic or redundant content, not factual errors.
+    - context_precision: For each context in order, decide if it is useful for arriving at the reference. Score the average precision over the useful contexts, so useful contexts ranked first score higher.
+    - context_recall: Break the reference into its claims. Score the fraction of claims that can be attributed to the contexts.
+
+    Return only the four scores.
+"""
+
+JUDGE_USER_PROMPT = """
+    QUESTION:
+    {question}
+
+    ANSWER:
+    {answer}
+
+    CONTEXTS:
+    {contexts}
+
+    REFERENCE:
+    {reference}
+"""
+
+JUDGE_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", JUDGE_SYSTEM_PROMPT),
+    ("user", JUDGE_USER_PROMPT)
+])
+
+def judge_samples(
+    questions: List[str],
+    answers: List[str],
+    contexts: List[List[str]],
+    references: List[str],
+    model: str = "gpt-4o-mini",
+    concurrency: int = 8
+    ) -> pd.DataFrame:
+    """
+    Score every sample with one judge call each, at most concurrency at once.
+
+    Returns the same columns as RAGAS to_pandas(), so the results CSV and evals_run_all.py work unchanged.
+    """
+    judge = JUDGE_PROMPT | ChatOpenAI(model=model, temperature=0).with_structured_output(
+        JudgeScores, method="json_schema", strict=True
+    )
+    scores = judge.batch(
+        [
+            {
+                "question": question,
+                "answer": answer,
+                "contexts": "\n\n".join(f"[{i}] {context}" for i, context in enumerate(sample_contexts, 1)),
+                "reference": reference
+            }
+            for question, answer, sample_contexts, reference in zip(questions, answers, contexts, references)
+        ],
+        config={"max_concurrency": concurrency}
+    )
+    return pd.DataFrame({
+        "user_input": questions,
+        "retrieved_contexts": contexts,
+        "response": answers,
+        "reference": references,
+        "faithfulness": [score.faithfulness for score in scores],
+        "answer_relevancy": [score.answer_relevancy for score in scores],
+        "context_precision": [score.context_precision for score in scores],
+        "context_recall": [score.context_recall for score in scores]
+    })
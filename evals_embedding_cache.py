@@ -0,0 +1,111 @@
+"""
+evals_embedding_cache.py
+Goal: OpenAI embeddings with a persistent on-disk cache, for the RAGAS evaluation scripts.
+
+Re-running an evaluation on the same test set embeds the same questions and answers again.
+Vectors are stored in a SQLite file keyed by a SHA-256 digest of the model, dimensions and text,
+so repeated runs only call OpenAI for texts that were never embedded before.
+"""
+
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import Dict, List
+
+import numpy as np
+from langchain_openai import OpenAIEmbeddings
+from pydantic import PrivateAttr
+
+# SQLite file holding the cached vectors, shared by every evaluation script
+EMBEDDING_CACHE_PATH = "embedding_cache.sqlite"
+
+# Texts sent per embeddings request (OpenAI accepts up to 2048); async batches are sent concurrently
+EMBEDDING_BATCH_SIZE = int(os.getenv("RAG_EMBEDDING_OPENAI_BATCH_SIZE", "512"))
+
+class CachedOpenAIEmbeddings(OpenAIEmbeddings):
+    """
+    OpenAIEmbeddings that looks every text up in the on-disk cache first and only embeds the misses,
+    EMBEDDING_BATCH_SIZE texts per request.
+    """
+
+    cache_path: str = EMBEDDING_CACHE_PATH
+
+    _connection: sqlite3.Connection = PrivateAttr(default=None)
+    _lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    def connection(self) -> sqlite3.Connection:
+        """Open the cache database on first use, creating the table if needed."""
+        if self._connection is None:
+            self._connection = sqlite3.connect(self.cache_path, check_same_thread=False)
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache (hash BLOB PRIMARY KEY, model TEXT, vec BLOB)"
+            )
+        return self._connection
+
+    def cache_key(self, text: str) -> bytes:
+        """SHA-256 of model, dimensions and text, so different embedding spaces never mix."""
+        return hashlib.sha256(f"{self.model}\x00{self.dimensions}\x00{text}".encode("utf-8")).digest()
+
+    def lookup(self, texts: List[str]) -> Dict[bytes, List[float]]:
+        """Cached vectors for the given texts, by cache key."""
+        keys = list({self.cache_key(text) for text in texts})
+        found = {}
+        with self._lock:
+            # SQLite limits the number of query parameters, so look keys up in slices
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                rows = self.connection().execute(
+                    f"SELECT hash, vec FROM cache WHERE hash IN ({', '.join('?' * len(batch))})", batch
+                )
+                for key, vec in rows:
+                    found[key] = np.frombuffer(vec, dtype=np.float32).tolist()
+        return found
+
+    def store(self, texts: List[str], vectors: List[List[float]]) -> None:
+        """Write freshly embedded vectors to the cache."""
+        with self._lock:
+            with self.connection() as connection:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO cache (hash, model, vec) VALUES (?, ?, ?)",
+                    [
+                        (self.cache_key(text), self.model, np.asarray(vector, dtype=np.float32).tobytes())
+                        for text, vector in zip(texts, vectors)
+                    ]
+                )
+
+    def embed_documents(self, texts: List[str], chunk_size: int = None, **kwargs) -> List[List[float]]:
+        """Embed texts, only sending the ones missing from the cache to OpenAI."""
+        cached = self.lookup(texts)
+        missing = list(dict.fromkeys(text for text in texts if self.cache_key(text) not in cached))
+        if missing:
+            vectors = super().embed_documents(missing, chunk_size=chunk_size or EMBEDDING_BATCH_SIZE, **kwargs)
+            self.store(missing, vectors)
+            cached.update(zip(map(self.cache_key, missing), vectors))
+        return [cached[self.cache_key(text)] for text in texts]
+
+    async def aembed_documents(self, texts: List[str], chunk_size: int = None, **kwargs) -> List[List[float]]:
+        """Async version of embed_documents."""
+        cached = self.lookup(texts)
+        missing = list(dict.fromkeys(text for text in texts if self.cache_key(text) not in cached))
+        if missing:
+            batch_size = chunk_size or EMBEDDING_BATCH_SIZE
+            batches = await asyncio.gather(*(
+                super(CachedOpenAIEmbeddings, self).aembed_documents(
+                    missing[start:start + batch_size], chunk_size=batch_size, **kwargs
+                )
+                for start in range(0, len(missing), batch_size)
+            ))
+            vectors = [vector for batch in batches for vector in batch]
+            self.store(missing, vectors)
+            cached.update(zip(map(self.cache_key, missing), vectors))
+        return [cached[self.cache_key(text)] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        """Embed one text through the cache."""
+        return self.embed_documents([text])[0]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        """Async version of embed_query."""
+        return (await self.aembed_documents([text]))[0]
@@ -12,21 +12,37 @@ Last Updated: 2024-11-15
 
 import sys
 import subprocess
+from importlib.metadata import version, PackageNotFoundError
 import pandas as pd
 from ragas import evaluate
 from ragas.metrics import context_precision, context_recall
-from datasets import Dataset
+from datasets import Dataset, Features, Sequence, Value
 import json
+import orjson
+from functools import lru_cache
 from pathlib import Path
-from datetime import datetime
 from dotenv import load_dotenv
 
 # Load Environment Variables:
 load_dotenv(".env", override=True)
 
+# Column types of the RAGAS dataset, declared so Arrow does not infer them from every row
+RAGAS_FEATURES = Features({
+    "question": Value("string"),
+    "answer": Value("string"),
+    "contexts": Sequence(Value("string")),
+    "ground_truth": Value("string")
+})
+
 #--------------------------------
 
 def install_old_ragas():
+    # Skip pip when the pinned version is already installed, it takes several seconds per run
+    try:
+        if version("ragas") == "0.1.21":
+            return
+    except PackageNotFoundError:
+        pass
     subprocess.check_call(
         [sys.executable, "-m", "pip", "install", "ragas==0.1.21"],
         stdout=subprocess.DEVNULL,  # Suppresses standard output
@@ -37,6 +53,8 @@ install_old_ragas()
 
 #--------------------------------
 
+# Parsed once per process and file; callers only read the test cases
+@lru_cache(maxsize=4)
 def load_test_set(filename: str = None):
     test_sets_dir = Path("test_sets")
     if not filename:
@@ -46,8 +64,8 @@ def load_test_set(filename: str = None):
         latest_test_set = max(test_sets, key=lambda x: x.stat().st_mtime)
         filename = latest_test_set.name
     
-    with open(test_sets_dir / filename) as f:
-        test_set = json.load(f)
+    with open(test_sets_dir / filename, "rb") as f:
+        test_set = orjson.loads(f.read())
     return test_set["questions"]
 
 def evaluate_context_metrics():
@@ -78,7 +96,7 @@ def evaluate_context_metrics():
         else:
             print(f"Warning: No generated answer found for question: {question[:100]}...")
 
-    dataset = Dataset.from_dict(data_samples)
+    dataset = Dataset.from_dict(data_samples, features=RAGAS_FEATURES)
 
     precision_scores = evaluate(dataset, metrics=[context_precision])
     recall_scores = evaluate(dataset, metrics=[context_recall])
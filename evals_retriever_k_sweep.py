@@ -0,0 +1,91 @@
+"""
+evals_retriever_k_sweep.py
+Goal: Pick the retriever k used in main.py by sweeping k against the test set.
+
+For each k, the MMR retriever is run on every test question and we measure how many of the
+ground truth contexts are retrieved, along with the average number of context tokens stuffed
+into the analysis prompt. The smallest k that keeps at least 95% of the coverage of k=10
+(the previous setting) is recommended.
+
+Last Updated: 2024-11-18
+"""
+
+import os
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import orjson
+import tiktoken
+from dotenv import load_dotenv
+from langchain_openai import OpenAIEmbeddings
+from langchain_pinecone import PineconeVectorStore
+
+# Load environment variables
+load_dotenv(".env", override=True)
+
+K_VALUES = [3, 5, 7, 10]
+BASELINE_K = 10
+COVERAGE_THRESHOLD = 0.95
+
+# Tokenizer of the analysis model, used to measure how much context each k adds to the prompt
+ENCODING = tiktoken.get_encoding("o200k_base")
+
+def load_test_set(filename: str = None):
+    """Load test questions from JSON file"""
+    test_sets_dir = Path("test_sets")
+    if not filename:
+        # Get the most recent test set with v2 naming pattern
+        test_sets = list(test_sets_dir.glob("test_set_v2_*.json"))
+        if not test_sets:
+            raise FileNotFoundError("No test sets found")
+        latest_test_set = max(test_sets, key=lambda x: x.stat().st_mtime)
+        filename = latest_test_set.name
+    
+    with open(test_sets_dir / filename, "rb") as f:
+        test_set = orjson.loads(f.read())
+    return test_set["questions"]
+
+def context_coverage(vectorstore: PineconeVectorStore, test_cases: List[Dict], k: int) -> Tuple[float, float]:
+    """Average share of ground truth contexts found in the top-k MMR results, and average context tokens."""
+    retriever = vectorstore.as_retriever(
+        search_type="mmr",
+        search_kwargs={"k": k, "fetch_k": max(20, 2 * k), "lambda_mult": 0.5}
+    )
+    
+    coverages = []
+    token_counts = []
+    for test_case in test_cases:
+        ground_truth_context = set(test_case["ground_truth_context"])
+        if not ground_truth_context:
+            continue
+        docs = retriever.invoke(test_case["question"])
+        retrieved = {doc.page_content for doc in docs}
+        coverages.append(len(ground_truth_context & retrieved) / len(ground_truth_context))
+        token_counts.append(len(ENCODING.encode("\n\n".join(doc.page_content for doc in docs))))
+    
+    if not coverages:
+        return 0.0, 0.0
+    return sum(coverages) / len(coverages), sum(token_counts) / len(token_counts)
+
+def sweep_k():
+    """Compute coverage for each k and return the smallest k that meets the threshold."""
+    test_cases = load_test_set()
+    
+    embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
+    vectorstore = PineconeVectorStore(
+        index_name=os.environ["PINECONE_INDEX_NAME"],
+        embedding=embeddings
+    )
+    
+    coverage = {}
+    for k in K_VALUES:
+        coverage[k], tokens = context_coverage(vectorstore, test_cases, k)
+        print(f"k={k}: coverage {coverage[k]:.3f}, {tokens:.0f} context tokens")
+    
+    target = COVERAGE_THRESHOLD * coverage[BASELINE_K]
+    best_k = min(k for k, score in coverage.items() if score >= target)
+    print(f"\nSmallest k keeping {COVERAGE_THRESHOLD:.0%} of k={BASELINE_K} coverage: {best_k}")
+    return best_k
+
+if __name__ == "__main__":
+    sweep_k()
@@ -37,19 +37,17 @@ subprocess.run(["python", "evals_precision_recall_V3.py"])
 # Read first csv file:
 rag_results = pd.read_csv('rag_results.csv')
 
-# Read second csv file:
-precision_recall_results = pd.read_csv('precision_recall_results.csv')
-
-# --------------------------------
-
-# Modify precision_recall_results for concat:
-updated_precision_recall_results = precision_recall_results[["Context Precision", "Context Recall"]]
+# Read second csv file, only the score columns are concatenated so skip parsing the rest:
+updated_precision_recall_results = pd.read_csv(
+    'precision_recall_results.csv',
+    usecols=["Context Precision", "Context Recall"]
+)
 
 # update rag_results for concat:
 updated_rag_results = rag_results.drop(columns=["reference"], inplace = True)
 
 # Concat both files based on row, since it'll always be the same lenjgth and order:
-new_df = pd.concat([rag_results, updated_precision_recall_results], axis=1)
+new_df = pd.concat([rag_results, updated_precision_recall_results], axis=1, copy=False)
 
 # Export to CSV, with time_stamp
 new_df.to_csv(f'evaluation_results_{time_stamp}.csv', index=False)
@@ -0,0 +1,220 @@
+"""
+examples.py
+PURPOSE: Example safety plans passed to the plan prompt as one-shot examples, to show the style and tone expected from the safety plan.
+
+EXAMPLE_SAFETY_PLANS is joined once at import, so main.py only passes a reference to the prompt on each request.
+EXAMPLE_TRIMMED is a condensed Trinity-Bellwoods example with the same section scaffolding and about a third of the size
+(723 vs 2193 characters), used in production; the full examples are kept for offline evaluation.
+"""
+
+# Define example safety plans
+TRINITY_BELLWOODS_EXAMPLE = """
+    **NEIGHBOURHOOD-SPECIFIC ASSESSMENT:**
+    Trinity-Bellwoods is a vibrant neighbourhood with a mix of residential and commercial areas. However, there have been reports of break and enters, assaults, and auto thefts. The park area, particularly during late hours, has been identified as a potential risk zone due to poor lighting.
+
+    **TARGETED SAFETY RECOMMENDATIONS:**
+    1. **Break and Enter**: 
+    - Prevention Strategies: Improve home security by keeping a record of valuables, identifying property using a Trace Identified pen
+    - Warning Signs: Suspicious activity around your property or neighbourhood
+    - Immediate Actions: Report suspicious activity to police
+    - Community Resources: Toronto Police Service's Break and Enter Prevention Guide
+
+    2. **Assault**: 
+    - Prevention Strategies: Avoid poorly lit areas, especially during late hours
+    - Warning Signs: Unfamiliar individuals or groups loitering in poorly lit areas
+    - Immediate Actions: Move to well-lit area with people around, call police
+    - Community Resources: Toronto Police Service's Personal Safety Guide
+
+    3. **Auto Theft**: 
+    - Prevention Strategies: Always lock your car, keep windows rolled up, park in well-lit areas
+    - Warning Signs: Suspicious individuals loitering around parking areas
+    - Immediate Actions: Report suspicious activity around vehicles to police
+    - Community Resources: Toronto Police Service's Auto Theft Prevention Guide
+
+    **PERSONAL SAFETY PROTOCOL:**
+    - Daily Safety Habits: Be aware of surroundings, keep home and vehicle secure
+    - Essential Safety Tools: Personal alarm, emergency numbers saved in phone
+    - Emergency Contact Information: Toronto Police Service (Non-Emergency): 416-808-2222
+    - Community Support Services: Neighbourhood Watch Program, Crime Stoppers
+
+    **PREVENTIVE MEASURES:**
+    - Home/Property Security: Install good quality locks, consider security system
+    - Personal Safety Technology: Use safety apps for location sharing
+    - Community Engagement: Join Neighbourhood Watch Program
+    - Reporting Procedures: Report suspicious activity to police non-emergency line
+"""
+
+# Condensed Trinity-Bellwoods example: same four sections, one concern and one bullet per subsection.
+# Phone numbers are left out, the plan footer template (PLAN_FOOTER_TEMPLATE in main.py) supplies the contact numbers.
+TRINITY_BELLWOODS_TRIMMED = """
+    **NEIGHBOURHOOD-SPECIFIC ASSESSMENT:**
+    Mixed residential and commercial area with reports of break and enters and assaults; the park is poorly lit late at night.
+
+    **TARGETED SAFETY RECOMMENDATIONS:**
+    1. **Break and Enter**: 
+    - Prevention Strategies: Record valuables, mark property with a Trace Identified pen
+    - Warning Signs: Suspicious activity around your property
+    - Immediate Actions: Report it to police
+    - Community Resources: TPS Break and Enter Prevention Guide
+
+    **PERSONAL SAFETY PROTOCOL:**
+    - Daily Safety Habits: Stay aware, keep home and vehicle secure
+
+    **PREVENTIVE MEASURES:**
+    - Community Engagement: Join Neighbourhood Watch
+"""
+
+YORK_UNIVERSITY_EXAMPLE = """
+    **NEIGHBOURHOOD-SPECIFIC ASSESSMENT:**
+    York University Heights is a diverse area centered around a major educational institution. The neighbourhood experiences higher foot traffic during academic terms, particularly around campus and student housing areas. Safety concerns are heightened during evening hours and in less populated areas.
+
+    **TARGETED SAFETY RECOMMENDATIONS:**
+    1. **Assault**: 
+    - Prevention Strategies: Use well-lit walkways, travel in groups, utilize campus safety services
+    - Warning Signs: Isolated areas, suspicious individuals, lack of pedestrian traffic
+    - Immediate Actions: Move to populated areas, contact campus security
+    - Community Resources: York University Security Services, goSAFE program
+
+    2. **Robbery**: 
+    - Prevention Strategies: Stay alert, avoid displaying valuable items
+    - Warning Signs: Being followed, suspicious gathering of individuals
+    - Immediate Actions: Move to safe location, contact security
+    - Community Resources: Toronto Police Service's Robbery Prevention Guide
+
+    **PERSONAL SAFETY PROTOCOL:**
+    - Daily Safety Habits: Plan routes in advance, stay in well-lit areas
+    - Essential Safety Tools: Fully charged phone, personal alarm
+    - Emergency Contacts: Campus Security (416-736-5333), Toronto Police
+    - Community Support: goSAFE escort service, York U Safety App
+
+    **PREVENTIVE MEASURES:**
+    - Personal Safety Technology: York U Safety App, location sharing
+    - Community Resources: Campus Walk Program, Security Shuttle Service
+    - Reporting Procedures: Use York U Safety App or call Campus Security
+    - Emergency Response: Program emergency numbers into phone
+"""
+
+ANNEX_EXAMPLE = """
+    CITY OF TORONTO SERVICE SAFETY PLAN
+    Neighbourhood: Annex (95)
+    Primary Concerns: Break and Enter: low, Assault: low
+
+    1. NEIGHBOURHOOD-SPECIFIC ASSESSMENT:
+
+    The Annex neighbourhood is generally safe with low rates of break-ins and assaults. However, like any urban area, it is not immune to crime. The primary concerns are break-ins and personal safety when walking alone at night. It is advisable to be extra cautious during late-night hours and in less populated areas. 
+
+    2. TARGETED SAFETY RECOMMENDATIONS:
+
+    Break-ins:
+    - Prevention Strategies: Continue to keep doors and windows locked at all times. Consider installing a peephole to see who is outside without opening the door. Verify a person's identification before opening the door.
+    - Warning Signs: Look out for suspicious activity in your neighbourhood, such as unfamiliar vehicles or individuals loitering around homes.
+    - Immediate Actions: If you notice signs of a break-in, do not enter your home. Go to a neighbour's house and call the police.
+    - Community Resources: Stay connected with your neighbourhood watch group and report any suspicious activity. 
+
+    Personal Safety:
+    - Prevention Strategies: Avoid walking alone late at night. Have your keys ready when approaching your home.
+    - Warning Signs: Be aware of your surroundings. If you notice someone following you or behaving suspiciously, seek help immediately.
+    - Immediate Actions: If you feel threatened, call 911 immediately. 
+    - Community Resources: Utilize the community app to stay informed about local incidents and safety alerts.
+
+    3. PERSONAL SAFETY PROTOCOL:
+
+    - Daily Safety Habits: Be aware of your surroundings, especially when walking alone at night. Keep your doors and windows locked at all times.
+    - Essential Safety Tools: Consider carrying a personal alarm or whistle. 
+    - Emergency Contact Information: Keep the local police station's non-emergency number (416-808-2222) saved in your phone. In case of an emergency, dial 911.
+    - Community Support Services: Stay active in your neighbourhood watch group and use the community app to stay informed.
+
+    4. PREVENTIVE MEASURES:
+
+    - Home/Property Security Recommendations: Consider installing a home security system or surveillance cameras. Report any burnt out lights on your property to the building superintendent or management immediately.
+    - Personal Safety Technology Suggestions: Consider using a personal safety app that can alert authorities or trusted contacts if you're in danger.
+    - Community Engagement Opportunities: Participate in community safety initiatives and events. Encourage your neighbours to join the neighbourhood watch group.
+    - Reporting Procedures: Report any suspicious activity to the police and advise the building superintendent or management. 
+
+    Remember, your safety is a priority. Stay vigilant, stay informed, and don't hesitate to reach out to the Toronto Police Service for any concerns or questions.
+
+    Sources Consulted:
+    - Break & Enter Prevention -  Toronto Police Service  (https://www.tps.ca/crime-prevention/break-and-enter-prevention/)
+    - Apartment, Condo Security -  Toronto Police Service  (https://www.tps.ca/crime-prevention/apartment-condo-security-1/)
+    - Crime Prevention Through Environmental Design -  Toronto Police Service  (https://www.tps.ca/crime-prevention/crime-prevention-through-environmental-design/)
+    - Crime Prevention -  Toronto Police Service  (https://www.tps.ca/crime-prevention/)
+    - Your Personal Safety Checklist ‚Äì City of Toronto (https://www.toronto.ca/community-people/public-safety-alerts/safety-tips-prevention/posters-pamphlets-and-other-safety-resources/your-personal-safety-checklist/)
+            
+    ----
+            
+    Note: This safety plan is generated based on Toronto Police Service resources and general 
+    safety guidelines. For emergencies, always call 911. For non-emergency police matters, 
+    call 416-808-2222.
+    """
+
+YORK_UNIVERSITY_HEIGHTS_EXAMPLE = """
+    CITY OF TORONTO SERVICE SAFETY PLAN
+    Neighbourhood: York University Heights (27)
+    Primary Concerns: Assault: High, Robbery: High
+
+    **1. NEIGHBOURHOOD-SPECIFIC ASSESSMENT:**
+
+    York University Heights is a vibrant community located in the northwestern part of Toronto. It is home to York University, which brings a diverse population of students, faculty, and residents. The area features a mix of residential, commercial, and educational spaces. However, like many urban areas, it faces challenges related to crime, particularly assault and robbery.
+
+    ate evenings and early mornings.
+
+    **2. TARGETED SAFETY RECOMMENDATIONS:**
+
+    **Assault:**
+    - **Prevention Strategies:** Avoid walking alone at night; use well-lit, busy streets. Consider walking with a friend or using public transportation.
+    - **Warning Signs:** Be aware of individuals loitering or following you. Trust your instincts if you feel uncomfortable.
+    - **Immediate Actions:** If you feel threatened, move to a populated area and call 9-1-1. Use your phone to alert someone of your location.
+    - **Community Resources:** Engage with campus security services and local police for safety escorts or patrols.
+
+    **Robbery:**
+    - **Prevention Strategies:** Keep valuables out of sight and avoid using your phone in isolated areas. Plan your routes to avoid high-risk areas.
+    - **Warning Signs:** Be cautious of individuals approaching you in a suspicious manner or asking for directions in secluded areas.
+    - **Immediate Actions:** If confronted, prioritize your safety over possessions. Comply with demands and call 9-1-1 when safe.
+    - **Community Resources:** Utilize Crime Stoppers to report suspicious activities anonymously.
+
+    **3. PERSONAL SAFETY PROTOCOL:**
+
+    - **Daily Safety Habits:** Develop a habit of checking your surroundings regularly. Plan and familiarize yourself with safe routes to and from your home.
+    - **Essential Safety Tools:** Carry a personal alarm or whistle. Use safety apps that allow real-time location sharing with trusted contacts.
+    - **Emergency Contacts:** Save emergency numbers on speed dial, including 9-1-1, Toronto Police non-emergency line (416-808-2222), and campus security.
+    - **Community Support Services:** Participate in local safety workshops and community meetings to stay informed and connected.
+
+    **4. PREVENTIVE MEASURES:**
+
+    - **Home/Property Security:** Ensure your home is well-lit and secure. Consider installing motion-sensor lights and security cameras.
+    - **Personal Safety Technology:** Use apps like "bSafe" or "Life360" for location sharing and emergency alerts.
+    - **Community Engagement:** Join or initiate a neighbourhood watch program. Attend community safety meetings to voice concerns and collaborate on solutions.
+    - **Reporting Procedures:** Report any suspicious activities to the Toronto Police Service. Use Crime Stoppers (1-800-222-8477) for anonymous tips.
+
+    By implementing these strategies, you can enhance your personal safety and contribute to a safer community environment in York University Heights. Stay informed, stay connected, and prioritize your safety in all situations.
+
+    Sources Consulted:
+    - Your Personal Safety Checklist – City of Toronto (https://www.toronto.ca/community-people/public-safety-alerts/safety-tips-prevention/posters-pamphlets-and-other-safety-resources/your-personal-safety-checklist/)
+    - Apartment, Condo Security -  Toronto Police Service  (https://www.tps.ca/crime-prevention/apartment-condo-security-1/)
+    - Transit Safety -  Toronto Police Service  (https://www.tps.ca/crime-prevention/transit-safety/)
+    - Crime Prevention Through Environmental Design -  Toronto Police Service  (https://www.tps.ca/crime-prevention/crime-prevention-through-environmental-design/)
+    - Crime Prevention -  Toronto Police Service  (https://www.tps.ca/crime-prevention/)
+    
+    ----
+    
+    Note: This safety plan is generated based on Toronto Police Service resources and general 
+    safety guidelines. For emergencies, always call 911. For non-emergency police matters, 
+    call 416-808-2222.
+    """
+
+# Create the list of examples
+# Too expensive to run these examples on every request, only passing one example.
+safety_plan_examples = [
+    ("Trinity-Bellwoods", TRINITY_BELLWOODS_EXAMPLE),
+    # ("Annex", ANNEX_EXAMPLE),
+    # ("York University Heights", YORK_UNIVERSITY_HEIGHTS_EXAMPLE),
+]
+
+# The examples do not depend on the request, so the block passed to the plan prompt is joined once at import
+EXAMPLE_SAFETY_PLANS = "\n\n".join(
+    f"=== EXAMPLE: {name} ===\n{example}" 
+    for name, example in safety_plan_examples
+)
+
+# Production block: the condensed example only, joined the same way as the full examples
+EXAMPLE_TRIMMED = f"=== EXAMPLE: Trinity-Bellwoods ===\n{TRINITY_BELLWOODS_TRIMMED}"
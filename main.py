@@ -18,275 +18,304 @@ Written by: Christine Tang
 
 # Import statements
 import os
-from typing import List, Dict
+import asyncio
+from typing import AsyncIterator, List, Dict, Tuple, Union
+from itertools import zip_longest
+from collections import OrderedDict
 import re
+import hashlib
+import orjson
+import uuid
+import atexit
+import sqlite3
+import threading
+from dataclasses import dataclass, field
+import httpx
+import numpy as np
+import tiktoken
+from functools import lru_cache
 
 # LangChain Imports
 from langchain_openai import OpenAIEmbeddings
-from langchain_pinecone import PineconeVectorStore
-from langchain_core.prompts import PromptTemplate
+from langchain_pinecone import PineconeVectorStore, PineconeRerank
+from langchain.retrievers import ContextualCompressionRetriever
+from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
+from langchain_core.documents import Document
+from langchain_core.runnables import RunnableConfig, RunnableLambda, RunnablePassthrough
+from langchain_core.rate_limiters import InMemoryRateLimiter
 from langchain_openai import ChatOpenAI
-from langchain.chains.combine_documents import create_stuff_documents_chain
-from langchain.chains.retrieval import create_retrieval_chain
+from langchain_core.tracers.langchain import wait_for_all_tracers
 from operator import itemgetter
+from pydantic import BaseModel, Field, PrivateAttr
+
+# Example safety plans for the plan prompt, joined once at import
+from examples import EXAMPLE_SAFETY_PLANS, EXAMPLE_TRIMMED
+from neighbourhoods import TORONTO_NEIGHBOURHOODS
 
 # Load environment variables
+# Variables already set in the environment (e.g. by the container) take precedence over .env
 from dotenv import load_dotenv
-load_dotenv(".env", override=True)
-
-# Define example safety plans
-TRINITY_BELLWOODS_EXAMPLE = """
-    **NEIGHBOURHOOD-SPECIFIC ASSESSMENT:**
-    Trinity-Bellwoods is a vibrant neighbourhood with a mix of residential and commercial areas. However, there have been reports of break and enters, assaults, and auto thefts. The park area, particularly during late hours, has been identified as a potential risk zone due to poor lighting.
-
-    **TARGETED SAFETY RECOMMENDATIONS:**
-    1. **Break and Enter**: 
-    - Prevention Strategies: Improve home security by keeping a record of valuables, identifying property using a Trace Identified pen
-    - Warning Signs: Suspicious activity around your property or neighbourhood
-    - Immediate Actions: Report suspicious activity to police
-    - Community Resources: Toronto Police Service's Break and Enter Prevention Guide
-
-    2. **Assault**: 
-    - Prevention Strategies: Avoid poorly lit areas, especially during late hours
-    - Warning Signs: Unfamiliar individuals or groups loitering in poorly lit areas
-    - Immediate Actions: Move to well-lit area with people around, call police
-    - Community Resources: Toronto Police Service's Personal Safety Guide
-
-    3. **Auto Theft**: 
-    - Prevention Strategies: Always lock your car, keep windows rolled up, park in well-lit areas
-    - Warning Signs: Suspicious individuals loitering around parking areas
-    - Immediate Actions: Report suspicious activity around vehicles to police
-    - Community Resources: Toronto Police Service's Auto Theft Prevention Guide
-
-    **PERSONAL SAFETY PROTOCOL:**
-    - Daily Safety Habits: Be aware of surroundings, keep home and vehicle secure
-    - Essential Safety Tools: Personal alarm, emergency numbers saved in phone
-    - Emergency Contact Information: Toronto Police Service (Non-Emergency): 416-808-2222
-    - Community Support Services: Neighbourhood Watch Program, Crime Stoppers
-
-    **PREVENTIVE MEASURES:**
-    - Home/Property Security: Install good quality locks, consider security system
-    - Personal Safety Technology: Use safety apps for location sharing
-    - Community Engagement: Join Neighbourhood Watch Program
-    - Reporting Procedures: Report suspicious activity to police non-emergency line
-"""
-
-YORK_UNIVERSITY_EXAMPLE = """
-    **NEIGHBOURHOOD-SPECIFIC ASSESSMENT:**
-    York University Heights is a diverse area centered around a major educational institution. The neighbourhood experiences higher foot traffic during academic terms, particularly around campus and student housing areas. Safety concerns are heightened during evening hours and in less populated areas.
-
-    **TARGETED SAFETY RECOMMENDATIONS:**
-    1. **Assault**: 
-    - Prevention Strategies: Use well-lit walkways, travel in groups, utilize campus safety services
-    - Warning Signs: Isolated areas, suspicious individuals, lack of pedestrian traffic
-    - Immediate Actions: Move to populated areas, contact campus security
-    - Community Resources: York University Security Services, goSAFE program
-
-    2. **Robbery**: 
-    - Prevention Strategies: Stay alert, avoid displaying valuable items
-    - Warning Signs: Being followed, suspicious gathering of individuals
-    - Immediate Actions: Move to safe location, contact security
-    - Community Resources: Toronto Police Service's Robbery Prevention Guide
-
-    **PERSONAL SAFETY PROTOCOL:**
-    - Daily Safety Habits: Plan routes in advance, stay in well-lit areas
-    - Essential Safety Tools: Fully charged phone, personal alarm
-    - Emergency Contacts: Campus Security (416-736-5333), Toronto Police
-    - Community Support: goSAFE escort service, York U Safety App
-
-    **PREVENTIVE MEASURES:**
-    - Personal Safety Technology: York U Safety App, location sharing
-    - Community Resources: Campus Walk Program, Security Shuttle Service
-    - Reporting Procedures: Use York U Safety App or call Campus Security
-    - Emergency Response: Program emergency numbers into phone
-"""
-
-# Create the list of examples
-safety_plan_examples = [
-    ("Trinity-Bellwoods", TRINITY_BELLWOODS_EXAMPLE),
-    ("York University Heights", YORK_UNIVERSITY_EXAMPLE)
-]
-
-# Functions - Safety Plan Generation
-
-def generate_safety_plan(
-    neighbourhood: str,
-    crime_type: List[str],
-    user_context: List[str],
-    ):
-    
+load_dotenv(".env")
+
+# Read once at import, so a missing index name fails immediately rather than on the first request
+PINECONE_INDEX_NAME = os.environ["PINECONE_INDEX_NAME"]
+
+# Retriever settings - MMR keeps the top matches while dropping near-duplicate chunks.
+# Starting defaults, not yet measured: confirm or retune them with evals_retriever_k_sweep.py
+RETRIEVER_SEARCH_TYPE = "mmr"
+RETRIEVER_SEARCH_KWARGS = {"k": 5, "fetch_k": 20, "lambda_mult": 0.5}
+
+# Upper bound on distinct sources passed to the analysis prompt, whatever the retriever returns
+MAX_RETRIEVED_SOURCES = 5
+
+# Optional two-stage retrieval: set RETRIEVER_RERANK_MODEL (e.g. "pinecone-rerank-v0" or "bge-reranker-v2-m3")
+# to fetch RERANK_FETCH_K candidates by similarity and keep the RERANK_TOP_N best according to Pinecone's reranker.
+RERANK_MODEL = os.getenv("RETRIEVER_RERANK_MODEL")
+RERANK_FETCH_K = 30
+RERANK_TOP_N = 4
+
+# Set RETRIEVER_PER_CONCERN=1 to run one retrieval query per crime concern, concurrently, and merge the rankings with
+# reciprocal rank fusion, so one concern does not dominate the single blended query of a multi-concern request.
+RETRIEVER_PER_CONCERN = os.getenv("RETRIEVER_PER_CONCERN", "").lower() in ("1", "true", "yes")
+RRF_K = 60
+
+# Concurrent retrieval queries arriving within this window share one embeddings request.
+# OpenAI accepts up to 2048 inputs per embeddings request.
+QUERY_BATCH_WINDOW_SECONDS = 0.05
+QUERY_BATCH_MAX_SIZE = 2048
+
+# Number of generated plans kept in memory; a repeated request returns the stored plan instead of calling the LLMs again.
+# Outputs only depend on the formatted request since both LLM calls run at temperature 0.
+PLAN_CACHE_SIZE = 512
+
+# Set SEMANTIC_CACHE_THRESHOLD (e.g. 0.97) to also reuse a plan when a request has the same neighbourhood and
+# crime concerns and user context answers whose embedding has at least this cosine similarity to a cached one.
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD", "0") or 0)
+
+# Set REDIS_URL (e.g. redis://localhost:6379) to keep the semantic cache in Redis (with the RediSearch module),
+# so every worker process of a web server shares the cached plans. Entries expire after REDIS_PLAN_TTL_SECONDS.
+REDIS_URL = os.getenv("REDIS_URL")
+REDIS_PLAN_INDEX = "plan_cache"
+REDIS_PLAN_TTL_SECONDS = int(os.getenv("REDIS_PLAN_TTL_SECONDS", "86400"))
+
+# Number of query embeddings kept in memory; repeat neighbourhood and crime combinations skip the OpenAI call
+QUERY_EMBEDDING_CACHE_SIZE = 4096
+
+# Set QUERY_EMBEDDING_CACHE_PATH to a SQLite file to keep query embeddings across restarts, e.g. for short-lived workers;
+# queries missing from memory are then looked up on disk before calling OpenAI
+QUERY_EMBEDDING_CACHE_PATH = os.getenv("QUERY_EMBEDDING_CACHE_PATH")
+
+# Set NEIGHBOURHOOD_MATCH_THRESHOLD (e.g. 0.85) to replace neighbourhood input that is not an exact Toronto
+# neighbourhood name (e.g. "York U Heights") by the closest known name when their embeddings have at least this
+# cosine similarity. Off by default, since every unknown name then costs an embeddings call.
+NEIGHBOURHOOD_MATCH_THRESHOLD = float(os.getenv("NEIGHBOURHOOD_MATCH_THRESHOLD", "0") or 0)
+
+# The neighbourhood name embeddings are saved here per embedding model and dimensions, so they are computed once.
+# Saving is best effort: on a read-only filesystem the table is kept in memory only.
+NEIGHBOURHOOD_EMBEDDINGS_DIR = os.getenv(
+    "NEIGHBOURHOOD_EMBEDDINGS_DIR", os.path.join(os.path.expanduser("~"), ".cache", "toronto_safety_plan")
+)
+KNOWN_NEIGHBOURHOODS = frozenset(TORONTO_NEIGHBOURHOODS)
+
+# Retries and rate limiting for OpenAI calls, tunable per account tier.
+# The OpenAI client retries 429s, 5xx and connection errors with exponential backoff and jitter.
+OPENAI_MAX_RETRIES = int(os.getenv("OPENAI_MAX_RETRIES", "3"))
+OPENAI_REQUESTS_PER_MINUTE = float(os.getenv("OPENAI_REQUESTS_PER_MINUTE", "500"))
+RETRIEVER_MAX_ATTEMPTS = 3
+
+# Shared by every chat model in the process, so concurrent requests stay under the RPM limit together
+CHAT_RATE_LIMITER = InMemoryRateLimiter(
+    requests_per_second=OPENAI_REQUESTS_PER_MINUTE / 60,
+    check_every_n_seconds=0.05,
+    max_bucket_size=max(1, OPENAI_REQUESTS_PER_MINUTE / 60)
+)
+
+# Shared HTTP/2 connection pools for every OpenAI client in the process.
+# HTTP/2 multiplexes concurrent requests over one TLS connection, so the handshake is paid once after warm-up.
+HTTP_LIMITS = httpx.Limits(max_keepalive_connections=100, max_connections=200)
+HTTP_TIMEOUT = httpx.Timeout(30.0)
+HTTP_CLIENT = httpx.Client(http2=True, timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS)
+
+class LoopLocalAsyncClient(httpx.AsyncClient):
     """
-    This code generates a safety plan based on specific neighbourhood and crime concerns.
+    httpx.AsyncClient that sends each request through a connection pool of the running event loop.
     
-    Chain of Thought is implemented, where the LLM is (1) Prompted to provide a detailed analysis considering only the information provided above, and (2) Prompted to provide a comprehensive and actionable safety plan that addresses the user's concerns and enhances their safety, in the City of Toronto.
+    Async connections belong to the event loop that opened them, so one pool shared by every loop breaks callers that
+    run asyncio.run more than once in a process. The clients of closed loops are dropped when a new loop starts sending.
     """
     
-    # Example Safety Plans
-    TRINITY_BELLWOODS_EXAMPLE = """
-        **NEIGHBOURHOOD-SPECIFIC ASSESSMENT:**
-        Trinity-Bellwoods is a vibrant neighbourhood with a mix of residential and commercial areas. However, there have been reports of break and enters, assaults, and auto thefts. The park area, particularly during late hours, has been identified as a potential risk zone due to poor lighting.
-
-        **TARGETED SAFETY RECOMMENDATIONS:**
-        1. **Break and Enter**: 
-        - Prevention Strategies: Improve home security by keeping a record of valuables, identifying property using a Trace Identified pen
-        - Warning Signs: Suspicious activity around your property or neighbourhood
-        - Immediate Actions: Report suspicious activity to police
-        - Community Resources: Toronto Police Service's Break and Enter Prevention Guide
-
-        2. **Assault**: 
-        - Prevention Strategies: Avoid poorly lit areas, especially during late hours
-        - Warning Signs: Unfamiliar individuals or groups loitering in poorly lit areas
-        - Immediate Actions: Move to well-lit area with people around, call police
-        - Community Resources: Toronto Police Service's Personal Safety Guide
-
-        3. **Auto Theft**: 
-        - Prevention Strategies: Always lock your car, keep windows rolled up, park in well-lit areas
-        - Warning Signs: Suspicious individuals loitering around parking areas
-        - Immediate Actions: Report suspicious activity around vehicles to police
-        - Community Resources: Toronto Police Service's Auto Theft Prevention Guide
-
-        **PERSONAL SAFETY PROTOCOL:**
-        - Daily Safety Habits: Be aware of surroundings, keep home and vehicle secure
-        - Essential Safety Tools: Personal alarm, emergency numbers saved in phone
-        - Emergency Contact Information: Toronto Police Service (Non-Emergency): 416-808-2222
-        - Community Support Services: Neighbourhood Watch Program, Crime Stoppers
-
-        **PREVENTIVE MEASURES:**
-        - Home/Property Security: Install good quality locks, consider security system
-        - Personal Safety Technology: Use safety apps for location sharing
-        - Community Engagement: Join Neighbourhood Watch Program
-        - Reporting Procedures: Report suspicious activity to police non-emergency line
-    """
-    
-    ANNEX_EXAMPLE = """
-        CITY OF TORONTO SERVICE SAFETY PLAN
-        Neighbourhood: Annex (95)
-        Primary Concerns: Break and Enter: low, Assault: low
-
-        1. NEIGHBOURHOOD-SPECIFIC ASSESSMENT:
-
-        The Annex neighbourhood is generally safe with low rates of break-ins and assaults. However, like any urban area, it is not immune to crime. The primary concerns are break-ins and personal safety when walking alone at night. It is advisable to be extra cautious during late-night hours and in less populated areas. 
-
-        2. TARGETED SAFETY RECOMMENDATIONS:
-
-        Break-ins:
-        - Prevention Strategies: Continue to keep doors and windows locked at all times. Consider installing a peephole to see who is outside without opening the door. Verify a person's identification before opening the door.
-        - Warning Signs: Look out for suspicious activity in your neighbourhood, such as unfamiliar vehicles or individuals loitering around homes.
-        - Immediate Actions: If you notice signs of a break-in, do not enter your home. Go to a neighbour's house and call the police.
-        - Community Resources: Stay connected with your neighbourhood watch group and report any suspicious activity. 
-
-        Personal Safety:
-        - Prevention Strategies: Avoid walking alone late at night. Have your keys ready when approaching your home.
-        - Warning Signs: Be aware of your surroundings. If you notice someone following you or behaving suspiciously, seek help immediately.
-        - Immediate Actions: If you feel threatened, call 911 immediately. 
-        - Community Resources: Utilize the community app to stay informed about local incidents and safety alerts.
-
-        3. PERSONAL SAFETY PROTOCOL:
-
-        - Daily Safety Habits: Be aware of your surroundings, especially when walking alone at night. Keep your doors and windows locked at all times.
-        - Essential Safety Tools: Consider carrying a personal alarm or whistle. 
-        - Emergency Contact Information: Keep the local police station's non-emergency number (416-808-2222) saved in your phone. In case of an emergency, dial 911.
-        - Community Support Services: Stay active in your neighbourhood watch group and use the community app to stay informed.
-
-        4. PREVENTIVE MEASURES:
-
-        - Home/Property Security Recommendations: Consider installing a home security system or surveillance cameras. Report any burnt out lights on your property to the building superintendent or management immediately.
-        - Personal Safety Technology Suggestions: Consider using a personal safety app that can alert authorities or trusted contacts if you're in danger.
-        - Community Engagement Opportunities: Participate in community safety initiatives and events. Encourage your neighbours to join the neighbourhood watch group.
-        - Reporting Procedures: Report any suspicious activity to the police and advise the building superintendent or management. 
-
-        Remember, your safety is a priority. Stay vigilant, stay informed, and don't hesitate to reach out to the Toronto Police Service for any concerns or questions.
-
-        Sources Consulted:
-        - Break & Enter Prevention -  Toronto Police Service  (https://www.tps.ca/crime-prevention/break-and-enter-prevention/)
-        - Apartment, Condo Security -  Toronto Police Service  (https://www.tps.ca/crime-prevention/apartment-condo-security-1/)
-        - Crime Prevention Through Environmental Design -  Toronto Police Service  (https://www.tps.ca/crime-prevention/crime-prevention-through-environmental-design/)
-        - Crime Prevention -  Toronto Police Service  (https://www.tps.ca/crime-prevention/)
-        - Your Personal Safety Checklist ‚Äì City of Toronto (https://www.toronto.ca/community-people/public-safety-alerts/safety-tips-prevention/posters-pamphlets-and-other-safety-resources/your-personal-safety-checklist/)
-                
-        ----
-                
-        Note: This safety plan is generated based on Toronto Police Service resources and general 
-        safety guidelines. For emergencies, always call 911. For non-emergency police matters, 
-        call 416-808-2222.
-        """
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.client_kwargs = kwargs
+        self.loop_clients: Dict[asyncio.AbstractEventLoop, httpx.AsyncClient] = {}
+        self.loop_clients_lock = threading.Lock()
     
-    YORK_UNIVERSITY_HEIGHTS_EXAMPLE = """
-            CITY OF TORONTO SERVICE SAFETY PLAN
-            Neighbourhood: York University Heights (27)
-            Primary Concerns: Assault: High, Robbery: High
-
-            **1. NEIGHBOURHOOD-SPECIFIC ASSESSMENT:**
-
-            York University Heights is a vibrant community located in the northwestern part of Toronto. It is home to York University, which brings a diverse population of students, faculty, and residents. The area features a mix of residential, commercial, and educational spaces. However, like many urban areas, it faces challenges related to crime, particularly assault and robbery.
-
-            ate evenings and early mornings.
-
-            **2. TARGETED SAFETY RECOMMENDATIONS:**
-
-            **Assault:**
-            - **Prevention Strategies:** Avoid walking alone at night; use well-lit, busy streets. Consider walking with a friend or using public transportation.
-            - **Warning Signs:** Be aware of individuals loitering or following you. Trust your instincts if you feel uncomfortable.
-            - **Immediate Actions:** If you feel threatened, move to a populated area and call 9-1-1. Use your phone to alert someone of your location.
-            - **Community Resources:** Engage with campus security services and local police for safety escorts or patrols.
-
-            **Robbery:**
-            - **Prevention Strategies:** Keep valuables out of sight and avoid using your phone in isolated areas. Plan your routes to avoid high-risk areas.
-            - **Warning Signs:** Be cautious of individuals approaching you in a suspicious manner or asking for directions in secluded areas.
-            - **Immediate Actions:** If confronted, prioritize your safety over possessions. Comply with demands and call 9-1-1 when safe.
-            - **Community Resources:** Utilize Crime Stoppers to report suspicious activities anonymously.
-
-            **3. PERSONAL SAFETY PROTOCOL:**
-
-            - **Daily Safety Habits:** Develop a habit of checking your surroundings regularly. Plan and familiarize yourself with safe routes to and from your home.
-            - **Essential Safety Tools:** Carry a personal alarm or whistle. Use safety apps that allow real-time location sharing with trusted contacts.
-            - **Emergency Contacts:** Save emergency numbers on speed dial, including 9-1-1, Toronto Police non-emergency line (416-808-2222), and campus security.
-            - **Community Support Services:** Participate in local safety workshops and community meetings to stay informed and connected.
-
-            **4. PREVENTIVE MEASURES:**
-
-            - **Home/Property Security:** Ensure your home is well-lit and secure. Consider installing motion-sensor lights and security cameras.
-            - **Personal Safety Technology:** Use apps like "bSafe" or "Life360" for location sharing and emergency alerts.
-            - **Community Engagement:** Join or initiate a neighbourhood watch program. Attend community safety meetings to voice concerns and collaborate on solutions.
-            - **Reporting Procedures:** Report any suspicious activities to the Toronto Police Service. Use Crime Stoppers (1-800-222-8477) for anonymous tips.
-
-            By implementing these strategies, you can enhance your personal safety and contribute to a safer community environment in York University Heights. Stay informed, stay connected, and prioritize your safety in all situations.
-
-            Sources Consulted:
-            - Your Personal Safety Checklist – City of Toronto (https://www.toronto.ca/community-people/public-safety-alerts/safety-tips-prevention/posters-pamphlets-and-other-safety-resources/your-personal-safety-checklist/)
-            - Apartment, Condo Security -  Toronto Police Service  (https://www.tps.ca/crime-prevention/apartment-condo-security-1/)
-            - Transit Safety -  Toronto Police Service  (https://www.tps.ca/crime-prevention/transit-safety/)
-            - Crime Prevention Through Environmental Design -  Toronto Police Service  (https://www.tps.ca/crime-prevention/crime-prevention-through-environmental-design/)
-            - Crime Prevention -  Toronto Police Service  (https://www.tps.ca/crime-prevention/)
-            
-            ----
-            
-            Note: This safety plan is generated based on Toronto Police Service resources and general 
-            safety guidelines. For emergencies, always call 911. For non-emergency police matters, 
-            call 416-808-2222.
-            """
-    
-    # Create list of safety plan exampls:
-    # Too expensive to run these examples on every request, only passing one example.
-    safety_plan_examples = [
-        ("Trinity-Bellwoods", TRINITY_BELLWOODS_EXAMPLE),
-        # ("Annex", ANNEX_EXAMPLE),
-        # ("York University Heights", YORK_UNIVERSITY_HEIGHTS_EXAMPLE),
-    ]
+    def loop_client(self) -> httpx.AsyncClient:
+        """Connection pool of the running event loop, created on its first request."""
+        loop = asyncio.get_running_loop()
+        client = self.loop_clients.get(loop)
+        if client is None:
+            with self.loop_clients_lock:
+                self.loop_clients = {
+                    other: other_client for other, other_client in self.loop_clients.items() if not other.is_closed()
+                }
+                client = self.loop_clients.setdefault(loop, httpx.AsyncClient(**self.client_kwargs))
+        return client
     
+    async def send(self, request: httpx.Request, **kwargs) -> httpx.Response:
+        return await self.loop_client().send(request, **kwargs)
     
-    # Define the prompt template
-    FIRST_SAFETY_PROMPT = PromptTemplate.from_template("""
+    async def aclose(self) -> None:
+        client = self.loop_clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+        await super().aclose()
+
+HTTP_ASYNC_CLIENT = LoopLocalAsyncClient(http2=True, timeout=HTTP_TIMEOUT, limits=HTTP_LIMITS)
+
+def close_http_clients():
+    """Close the shared connection pools on interpreter exit."""
+    # Async pools of event loops that have already closed are dropped with them
+    HTTP_CLIENT.close()
+
+atexit.register(close_http_clients)
+
+# OpenAI embedding model for retrieval queries, which must match the model the index was built with.
+# text-embedding-3-small truncated to 1024 dimensions (matryoshka) keeps most of the retrieval quality at a
+# fraction of the cost and vector size: build it with `python modified_ingestion.py --small`, then set
+# PINECONE_INDEX_NAME=torontopolice2-small, EMBEDDING_MODEL=text-embedding-3-small and EMBEDDING_DIMENSIONS=1024.
+EMBEDDING_MODEL = os.getenv("EMBEDDING_MODEL", "text-embedding-3-large")
+EMBEDDING_DIMENSIONS = int(os.environ["EMBEDDING_DIMENSIONS"]) if os.getenv("EMBEDDING_DIMENSIONS") else None
+
+# Set PINECONE_USE_GRPC=1 to send synchronous Pinecone queries over gRPC, which multiplexes
+# concurrent queries on one persistent connection. Needs pinecone[grpc].
+PINECONE_USE_GRPC = os.getenv("PINECONE_USE_GRPC", "").lower() in ("1", "true", "yes")
+
+# Set FAISS_INDEX_PATH to a local FAISS index built by modified_ingestion.py --faiss to search the corpus in process,
+# without a Pinecone round trip per query. The corpus is small and static, so the index fits in memory. Needs faiss-cpu.
+# The embedding model the index was built with is recorded in FAISS_EMBEDDING_FILE and must match the query embeddings.
+FAISS_INDEX_PATH = os.getenv("FAISS_INDEX_PATH")
+FAISS_EMBEDDING_FILE = "embedding_model.json"
+
+# Optional local query embeddings. When PINECONE_BGE_INDEX_NAME points to an index built with
+# `python modified_ingestion.py --bge`, queries are embedded on CPU with BGE-small instead of
+# calling the OpenAI embeddings API. Otherwise the EMBEDDING_MODEL index is used.
+BGE_MODEL_NAME = "BAAI/bge-small-en-v1.5"
+
+# Set SAFETY_PLAN_OUTPUT=json to have the plan returned as JSON sections (OpenAI structured outputs)
+# and rendered with PLAN_SECTIONS_TEMPLATE, instead of parsing free-form markdown.
+PLAN_OUTPUT_FORMAT = os.getenv("SAFETY_PLAN_OUTPUT", "markdown")
+
+# Set SAFETY_PLAN_DEBUG=1 to print prompts and responses to stdout while developing.
+# Off by default; LangSmith tracing covers observability without the per-event stdout work.
+DEBUG = os.getenv("SAFETY_PLAN_DEBUG", "").lower() in ("1", "true", "yes")
+
+# Set LLM_CACHE=1 while developing to replay chat responses from a local SQLite file when the prompt and model
+# settings are identical, so re-running the demo or checking plan formatting makes no LLM calls. Not for serving users.
+LLM_CACHE = os.getenv("LLM_CACHE", "").lower() in ("1", "true", "yes")
+LLM_CACHE_PATH = ".llm_cache.db"
+if LLM_CACHE:
+    # Imported here so the default path does not load SQLAlchemy
+    from langchain_community.cache import SQLiteCache
+    from langchain_core.globals import set_llm_cache
+    set_llm_cache(SQLiteCache(database_path=LLM_CACHE_PATH))
+
+# Chat models - the analysis step is structured brainstorming that a small model handles well,
+# only the final plan the user reads goes to the larger model.
+# Both can be overridden with env vars to A/B models in the evaluation scripts.
+ANALYSIS_MODEL = os.getenv("ANALYSIS_MODEL", "gpt-4o-mini")
+PLAN_MODEL = os.getenv("PLAN_MODEL", "gpt-4o")
+
+# The plan prompts use the condensed example, about a third of the size of the full one (723 vs 2193 characters).
+# Set SAFETY_PLAN_FULL_EXAMPLES=1 to use the full examples, e.g. to compare plan quality in the evaluation scripts.
+FULL_EXAMPLES = os.getenv("SAFETY_PLAN_FULL_EXAMPLES", "").lower() in ("1", "true", "yes")
+PLAN_EXAMPLES = EXAMPLE_SAFETY_PLANS if FULL_EXAMPLES else EXAMPLE_TRIMMED
+
+PLAN_SECTIONS_TEMPLATE = """1. NEIGHBOURHOOD-SPECIFIC ASSESSMENT:
+{assessment}
+
+2. TARGETED SAFETY RECOMMENDATIONS:
+{recommendations}
+
+3. PERSONAL SAFETY PROTOCOL:
+{protocol}
+
+4. PREVENTIVE MEASURES:
+{preventive}"""
+
+# User request passed to the analysis chain, filled with str.format_map
+USER_INPUT_TEMPLATE = """
+        LOCATION: {neighbourhood}
+        
+        SAFETY CONCERNS:
+        - {primary_concerns}
+        
+        ADDITIONAL USER CONTEXT:
+        {user_context}
+        """
+
+# General plan returned straight away when a request has no neighbourhood or no crime concerns,
+# since retrieval and the LLM calls have nothing specific to work with.
+GENERIC_PLAN_BODY = """1. NEIGHBOURHOOD-SPECIFIC ASSESSMENT:
+No neighbourhood or safety concerns were provided, so this plan gives general safety guidance for Toronto. Select your neighbourhood and the concerns that matter to you for a tailored plan.
+
+2. TARGETED SAFETY RECOMMENDATIONS:
+- Stay aware of your surroundings, especially in isolated or poorly lit areas and late at night.
+- Keep doors, windows and vehicles locked, and keep valuables out of sight.
+- Report suspicious activity to the Toronto Police Service.
+
+3. PERSONAL SAFETY PROTOCOL:
+- Carry a charged phone and plan safe routes to and from home.
+- Let someone you trust know where you are going and when you expect to return.
+- Keep emergency contacts saved on your phone and written down at home.
+
+4. PREVENTIVE MEASURES:
+- Use good lighting and secure locks at home, and consider a security system or doorbell camera.
+- Get involved in community programs such as Neighbourhood Watch.
+- For emergencies call 911. For non-emergency police matters call 416-808-2222."""
+
+GENERIC_PLAN_SOURCES = [
+    ("Crime Prevention -  Toronto Police Service", "https://www.tps.ca/crime-prevention/"),
+    ("Your Personal Safety Checklist – City of Toronto", "https://www.toronto.ca/community-people/public-safety-alerts/safety-tips-prevention/posters-pamphlets-and-other-safety-resources/your-personal-safety-checklist/")
+]
+
+# Header and footer placed around every safety plan, filled with str.format_map
+PLAN_HEADER_TEMPLATE = """CITY OF TORONTO SERVICE SAFETY PLAN
+Neighbourhood: {neighbourhood}
+Primary Concerns: {primary_concerns}
+
+"""
+
+PLAN_FOOTER_TEMPLATE = """
+
+Sources Consulted:
+{sources}
+
+----
+
+Note: This safety plan is generated based on Toronto Police Service resources and general 
+safety guidelines. For emergencies, always call 911. For non-emergency police matters, 
+call 416-808-2222.
+"""
+
+PLAN_TEMPLATE = PLAN_HEADER_TEMPLATE + "{body}" + PLAN_FOOTER_TEMPLATE
+
+# Header lines the plan LLM sometimes repeats at the start of the plan, removed since the header is added separately.
+# Only a run of them at the very start is removed, so the plan text itself is never touched.
+DUPLICATE_HEADER_PATTERN = re.compile(
+    r"\A\s*(?:(?:CITY OF TORONTO SERVICE SAFETY PLAN|Neighbourhood:[^\n]*|Primary Concerns:[^\n]*)\s*)+"
+)
+
+# Define the prompt templates, compiled once at import.
+# Static instructions go first in a system message and user-specific text last,
+# so the prompt prefix is identical across requests and can be served from OpenAI's prompt cache.
+FIRST_SAFETY_SYSTEM_PROMPT = """
     You are a City of Toronto safety advisor specializing in crime prevention and public safety in Toronto, Ontario.
 
     Your goal is to brainstorm and analyze safety concerns and resources to generate actionable insights for creating an effective safety plan. The target audience is a member of the general public in Toronto.
 
-    USER REQUEST:
-    {input}
-
-    RELEVANT TORONTO POLICE, CITY OF TORONTO, AND GOVERNMENT RESOURCES:
-    {context}
+    You will be given a USER REQUEST and RELEVANT TORONTO POLICE, CITY OF TORONTO, AND GOVERNMENT RESOURCES.
     
     Please brainstorm and analyze the information, considering the perspective of the general public in Toronto.
 
@@ -330,26 +359,28 @@ def generate_safety_plan(
     Focus on providing practical, accessible guidance that Toronto residents can realistically implement in their daily lives. Maintain factual accuracy and proper citation of sources.
     
     Refrain from providing legal, medical, financial or personal or professional advice, stay within the scope of a safety plan and a role as a safety advisor.
-    """)
-    
-    SECOND_SAFETY_PROMPT = PromptTemplate.from_template("""
+"""
+
+FIRST_SAFETY_USER_PROMPT = """
+    USER REQUEST:
+    {input}
+
+    RELEVANT TORONTO POLICE, CITY OF TORONTO, AND GOVERNMENT RESOURCES:
+    {context}
+"""
+
+SECOND_SAFETY_SYSTEM_PROMPT = """
     You are a City of Toronto safety advisor specializing in crime prevention and public safety in Toronto, Ontario. 
     
     IMPORTANT: DO NOT include any headers about city name, neighbourhood, or primary concerns. Start directly with the neighbourhood assessment section.
+    DO NOT include a "Sources Consulted" section or list of sources at the end, the sources are appended to the plan separately.
     
     Your goal is to transform the provided analysis into an actionable, tailored safety plan that supports the user's safety concerns and enhances their safety, in the City of Toronto. Your tone should be respectful and professional.
-    
-    You are provided the following information regarding the user:
-    {input}
-    
-    I have conducted the following analysis regarding the user's request and the relevant resources:
-    <analysis>
-    {analysis}
-    </analysis>
 
     Here are some example safety plans to guide your format:
     {example_safety_plans}
     
+    You will be provided information regarding the user, and an analysis of the user's request and the relevant resources.
     Based on the provided information and examples above, create a detailed safety plan that adheres to the structure of the following 4 sections:
 
     1. NEIGHBOURHOOD-SPECIFIC ASSESSMENT:
@@ -390,131 +421,1226 @@ def generate_safety_plan(
     Refrain from providing legal, medical, financial, personal or professional advice, stay within the scope of a safety plan and a role as a safety advisor.
 
     Remember: Focus on prevention and awareness without causing undue alarm. Empower the user with knowledge and practical steps they can take to enhance their safety.
-    """)
+"""
+
+SECOND_SAFETY_USER_PROMPT = """
+    You are provided the following information regarding the user:
+    {input}
     
-    # Format the crime concerns for the prompt
-    formatted_crime_concerns = ", ".join(crime_type)
-    formatted_context = "\n".join(user_context)
+    I have conducted the following analysis regarding the user's request and the relevant resources:
+    <analysis>
+    {analysis}
+    </analysis>
+"""
+
+FIRST_SAFETY_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", FIRST_SAFETY_SYSTEM_PROMPT),
+    ("user", FIRST_SAFETY_USER_PROMPT)
+])
+
+SECOND_SAFETY_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", SECOND_SAFETY_SYSTEM_PROMPT),
+    ("user", SECOND_SAFETY_USER_PROMPT)
+]).partial(example_safety_plans=PLAN_EXAMPLES)
+
+# Single-pass prompt: the model writes its analysis and the plan in one response, saving a full LLM round trip.
+# Enabled with SAFETY_PLAN_SINGLE_PASS=1; the analysis stays visible in the LangSmith trace of the LLM call.
+SINGLE_PASS = os.getenv("SAFETY_PLAN_SINGLE_PASS", "").lower() in ("1", "true", "yes")
+
+FUSED_SAFETY_SYSTEM_PROMPT = FIRST_SAFETY_SYSTEM_PROMPT + """
+    Write this analysis inside <analysis></analysis> tags. Then, after the closing </analysis> tag, use your analysis to write the safety plan as instructed below.
+""" + SECOND_SAFETY_SYSTEM_PROMPT
+
+FUSED_SAFETY_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", FUSED_SAFETY_SYSTEM_PROMPT),
+    ("user", FIRST_SAFETY_USER_PROMPT)
+]).partial(example_safety_plans=PLAN_EXAMPLES)
+
+# Single-pass prompt for SAFETY_PLAN_OUTPUT=json: the analysis and the plan sections are fields of one structured response
+FUSED_JSON_SAFETY_SYSTEM_PROMPT = FIRST_SAFETY_SYSTEM_PROMPT + """
+    Write this analysis in the analysis field. Then use your analysis to write the safety plan in the plan field as instructed below.
+""" + SECOND_SAFETY_SYSTEM_PROMPT
+
+FUSED_JSON_SAFETY_PROMPT = ChatPromptTemplate.from_messages([
+    ("system", FUSED_JSON_SAFETY_SYSTEM_PROMPT),
+    ("user", FIRST_SAFETY_USER_PROMPT)
+]).partial(example_safety_plans=PLAN_EXAMPLES)
+
+# Pattern for the analysis block written before the plan in single-pass responses
+ANALYSIS_BLOCK_PATTERN = re.compile(r"<analysis>.*?</analysis>", re.DOTALL)
+
+# Token budget per LLM call (gpt-4o and gpt-4o-mini have a 128k context window), overridable to cap prompt costs.
+# Survey answers that would push a prompt over the budget are cut before any retrieval or LLM call is made.
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "128000"))
+OUTPUT_RESERVE_TOKENS = 1500
+# Token budget of the retrieved documents in the {context} block; documents past it are cut, lowest ranked first
+RETRIEVED_CONTEXT_TOKENS = int(os.getenv("RETRIEVED_CONTEXT_TOKENS", "3000"))
+# Placed between the retrieved documents in the {context} block
+CONTEXT_SEPARATOR = "\n\n"
+
+# The largest fixed part of any prompt the request goes into: static text, retrieved context and the reserved analysis/plan.
+# Measured in UTF-8 bytes at import, which is never less than the token count, so most requests skip tokenizing entirely.
+STATIC_PROMPT_TEXTS = [
+    FIRST_SAFETY_SYSTEM_PROMPT + FIRST_SAFETY_USER_PROMPT + USER_INPUT_TEMPLATE,
+    SECOND_SAFETY_SYSTEM_PROMPT.replace("{example_safety_plans}", PLAN_EXAMPLES) + SECOND_SAFETY_USER_PROMPT + USER_INPUT_TEMPLATE,
+    FUSED_SAFETY_SYSTEM_PROMPT.replace("{example_safety_plans}", PLAN_EXAMPLES) + FIRST_SAFETY_USER_PROMPT + USER_INPUT_TEMPLATE
+]
+USER_CONTEXT_MIN_BUDGET = (
+    PROMPT_TOKEN_BUDGET - RETRIEVED_CONTEXT_TOKENS - 2 * OUTPUT_RESERVE_TOKENS
+    - max(len(text.encode()) for text in STATIC_PROMPT_TEXTS)
+)
+
+# Classes - Retrieval
+
+class QueryEmbeddings(OpenAIEmbeddings):
+    """
+    OpenAI embeddings used by the safety plan retriever.
     
-    # Initialize components
-    embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
-    vectorstore = PineconeVectorStore(
-        index_name=os.environ["PINECONE_INDEX_NAME"],
-        embedding=embeddings
+    Recently embedded queries are kept in an LRU cache keyed by model, dimensions and a hash of the text, so repeated requests skip the OpenAI call.
+    
+    When many users are served concurrently, query embeddings requested within QUERY_BATCH_WINDOW_SECONDS of each other are sent to OpenAI as a single batch, and each Pinecone query then runs in parallel with its own vector.
+    """
+    
+    _pending_queries: Dict = PrivateAttr(default_factory=dict)
+    _query_cache: OrderedDict = PrivateAttr(default_factory=OrderedDict)
+    # Retriever threads of a batch share the LRU cache, so every access to it holds this lock
+    _query_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    _disk_cache: sqlite3.Connection = PrivateAttr(default=None)
+    _disk_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+    
+    def cache_key(self, text: str) -> Tuple:
+        """
+        Key cached vectors by a SHA-256 digest of the text, so long formatted requests are not kept in memory twice.
+        Model and dimensions are part of the key too, so different embedding spaces never mix.
+        """
+        return (self.model, self.dimensions, hashlib.sha256(text.encode("utf-8")).hexdigest())
+    
+    def disk_cache(self) -> sqlite3.Connection:
+        """Open the QUERY_EMBEDDING_CACHE_PATH database on first use, creating the table if needed."""
+        if self._disk_cache is None:
+            self._disk_cache = sqlite3.connect(QUERY_EMBEDDING_CACHE_PATH, check_same_thread=False)
+            self._disk_cache.execute("CREATE TABLE IF NOT EXISTS cache (hash BLOB PRIMARY KEY, model TEXT, vec BLOB)")
+        return self._disk_cache
+    
+    def disk_key(self, text: str) -> bytes:
+        """SHA-256 of model, dimensions and text, the same key and table as the evaluation embedding cache."""
+        return hashlib.sha256(f"{self.model}\x00{self.dimensions}\x00{text}".encode("utf-8")).digest()
+    
+    def get_cached_query(self, text: str) -> Union[List[float], None]:
+        """Return the cached vector for text, marking it as recently used."""
+        key = self.cache_key(text)
+        with self._query_lock:
+            vector = self._query_cache.get(key)
+            if vector is not None:
+                self._query_cache.move_to_end(key)
+                return vector
+        if QUERY_EMBEDDING_CACHE_PATH:
+            with self._disk_lock:
+                row = self.disk_cache().execute("SELECT vec FROM cache WHERE hash = ?", (self.disk_key(text),)).fetchone()
+            if row is not None:
+                vector = np.frombuffer(row[0], dtype=np.float32).tolist()
+                self.remember_query(key, vector)
+        return vector
+    
+    def remember_query(self, key: Tuple, vector: List[float]) -> None:
+        """Keep a vector in memory, evicting the least recently used one when full."""
+        with self._query_lock:
+            self._query_cache[key] = vector
+            if len(self._query_cache) > QUERY_EMBEDDING_CACHE_SIZE:
+                self._query_cache.popitem(last=False)
+    
+    def cache_query(self, text: str, vector: List[float]) -> None:
+        """Store a freshly embedded query vector in memory, and on disk when QUERY_EMBEDDING_CACHE_PATH is set."""
+        self.remember_query(self.cache_key(text), vector)
+        if QUERY_EMBEDDING_CACHE_PATH:
+            with self._disk_lock, self.disk_cache() as connection:
+                connection.execute(
+                    "INSERT OR REPLACE INTO cache (hash, model, vec) VALUES (?, ?, ?)",
+                    (self.disk_key(text), self.model, np.asarray(vector, dtype=np.float32).tobytes())
+                )
+    
+    def embed_query(self, text: str) -> List[float]:
+        """Embed a query, using the cache when the same query was seen recently."""
+        vector = self.get_cached_query(text)
+        if vector is None:
+            vector = super().embed_query(text)
+            self.cache_query(text, vector)
+        return vector
+    
+    def prefetch_queries(self, texts: List[str]) -> None:
+        """Embed the uncached queries in one OpenAI request and cache them, so later embed_query calls are all hits."""
+        missing = list(dict.fromkeys(text for text in texts if self.get_cached_query(text) is None))
+        if missing:
+            for text, vector in zip(missing, self.embed_documents(missing)):
+                self.cache_query(text, vector)
+    
+    async def aembed_query(self, text: str) -> List[float]:
+        """Queue the query and wait for its batch to be embedded."""
+        vector = self.get_cached_query(text)
+        if vector is not None:
+            return vector
+        
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        batch = self._pending_queries.setdefault(loop, [])
+        batch.append((text, future))
+        if len(batch) == 1:
+            loop.call_later(QUERY_BATCH_WINDOW_SECONDS, self.flush_queries, loop)
+        elif len(batch) >= QUERY_BATCH_MAX_SIZE:
+            self.flush_queries(loop)
+        return await future
+    
+    def flush_queries(self, loop: asyncio.AbstractEventLoop) -> None:
+        """Send the queries waiting on this event loop as one embeddings request."""
+        batch = self._pending_queries.pop(loop, None)
+        if batch:
+            loop.create_task(self.embed_query_batch(batch))
+    
+    async def embed_query_batch(self, batch: List[Tuple[str, asyncio.Future]]) -> None:
+        """Embed a batch of queries and hand each vector back to its caller."""
+        try:
+            vectors = await self.aembed_documents([text for text, _ in batch])
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (text, future), vector in zip(batch, vectors):
+            self.cache_query(text, vector)
+            if not future.done():
+                future.set_result(vector)
+
+# Classes - Safety Plan
+
+class ConcernRecommendations(BaseModel):
+    """Targeted safety recommendations for one of the user's concerns."""
+    concern: str = Field(description="The safety concern, e.g. Assault")
+    recommendations: str = Field(description="Prevention strategies, warning signs, immediate actions and community resources for this concern")
+
+class SafetyPlanSections(BaseModel):
+    """The four sections of a safety plan, as returned by the plan LLM call when SAFETY_PLAN_OUTPUT=json."""
+    assessment: str = Field(description="1. NEIGHBOURHOOD-SPECIFIC ASSESSMENT")
+    recommendations: List[ConcernRecommendations] = Field(description="2. TARGETED SAFETY RECOMMENDATIONS, one entry per concern")
+    protocol: str = Field(description="3. PERSONAL SAFETY PROTOCOL")
+    preventive: str = Field(description="4. PREVENTIVE MEASURES")
+
+class FusedSafetyPlanSections(BaseModel):
+    """Analysis and plan sections written in one LLM call, when SAFETY_PLAN_SINGLE_PASS=1 and SAFETY_PLAN_OUTPUT=json."""
+    analysis: str = Field(description="Analysis of the user's request and the provided resources, written before the plan")
+    plan: SafetyPlanSections = Field(description="The safety plan written from the analysis")
+
+@dataclass(slots=True, frozen=True)
+class SafetyPlan:
+    """
+    A generated safety plan, kept in parts so callers can log, cache or render each section separately.
+    
+    str(plan) gives the full formatted plan returned by generate_safety_plan.
+    """
+    neighbourhood: str
+    primary_concerns: str
+    body: str
+    sources: List[Tuple[str, str]] = field(default_factory=list)
+    # Text of the retrieved documents the plan was written from, e.g. for scoring faithfulness; not part of str(plan)
+    contexts: List[str] = field(default_factory=list)
+    
+    def __str__(self) -> str:
+        return PLAN_TEMPLATE.format_map({
+            "neighbourhood": self.neighbourhood,
+            "primary_concerns": self.primary_concerns,
+            "body": self.body,
+            "sources": format_sources(self.sources)
+        })
+
+# Classes - Plan Caching
+
+class SemanticPlanCache:
+    """
+    Generated plans looked up by the meaning of the user's answers.
+    
+    Plans are only compared within the same neighbourhood and set of crime concerns, so a hit never returns a plan written for a different request header.
+    Within that group, the cached plan whose user context embedding is most similar is returned if its cosine similarity reaches the threshold.
+    """
+    
+    def __init__(self, threshold: float, max_size: int):
+        self.threshold = threshold
+        self.max_size = max_size
+        self.size = 0
+        # (neighbourhood, sorted crime concerns) -> (N, dimensions) matrix of normalized context vectors and their N plans,
+        # kept stacked so a lookup is a single matrix-vector product
+        self.groups: Dict[Tuple[str, Tuple[str, ...]], Tuple[np.ndarray, List[SafetyPlan]]] = {}
+    
+    @staticmethod
+    def group_key(neighbourhood: str, crime_type: List[str]) -> Tuple[str, Tuple[str, ...]]:
+        return (neighbourhood, tuple(sorted(crime_type)))
+    
+    def lookup(self, neighbourhood: str, crime_type: List[str], vector: np.ndarray) -> Union[SafetyPlan, None]:
+        """Return the most similar cached plan for this request, or None if none is close enough."""
+        group = self.groups.get(self.group_key(neighbourhood, crime_type))
+        if group is None:
+            return None
+        vectors, plans = group
+        similarities = vectors @ vector
+        best = int(np.argmax(similarities))
+        if similarities[best] >= self.threshold:
+            return plans[best]
+        return None
+    
+    def add(self, neighbourhood: str, crime_type: List[str], vector: np.ndarray, safety_plan: SafetyPlan) -> None:
+        """Store a generated plan, unless the cache is full."""
+        if self.size >= self.max_size:
+            return
+        key = self.group_key(neighbourhood, crime_type)
+        vectors, plans = self.groups.get(key, (np.empty((0, len(vector)), dtype=np.float32), []))
+        # Adds only happen on a miss, after a full generation, so copying the group's matrix here is cheap
+        self.groups[key] = (np.vstack([vectors, vector]), plans + [safety_plan])
+        self.size += 1
+
+class RedisPlanCache:
+    """
+    SemanticPlanCache stored in Redis, shared by every process using the same Redis server.
+    
+    Each plan is a hash holding its context vector, a tag for its (neighbourhood, crime concerns) group and the plan as JSON.
+    A lookup is one KNN query on the RediSearch vector index, filtered to the request's group.
+    """
+    
+    def __init__(self, url: str, threshold: float, ttl_seconds: int):
+        # Imported here so the default path does not need redis installed
+        import redis
+        self.client = redis.Redis.from_url(url)
+        self.threshold = threshold
+        self.ttl_seconds = ttl_seconds
+        self.index_ready = False
+    
+    @staticmethod
+    def group_tag(neighbourhood: str, crime_type: List[str]) -> str:
+        return hashlib.sha256(repr(SemanticPlanCache.group_key(neighbourhood, crime_type)).encode()).hexdigest()
+    
+    def ensure_index(self, dimensions: int) -> None:
+        """Create the vector index on first use; the dimension comes from the first embedding seen."""
+        if self.index_ready:
+            return
+        try:
+            self.client.execute_command(
+                "FT.CREATE", REDIS_PLAN_INDEX, "ON", "HASH", "PREFIX", 1, "plan:",
+                "SCHEMA",
+                "group", "TAG",
+                "embedding", "VECTOR", "HNSW", 6, "TYPE", "FLOAT32", "DIM", dimensions, "DISTANCE_METRIC", "COSINE"
+            )
+        except Exception as error:
+            # Another worker created it first
+            if "Index already exists" not in str(error):
+                raise
+        self.index_ready = True
+    
+    def lookup(self, neighbourhood: str, crime_type: List[str], vector: np.ndarray) -> Union[SafetyPlan, None]:
+        """Return the most similar cached plan for this request, or None if none is close enough."""
+        self.ensure_index(len(vector))
+        result = self.client.execute_command(
+            "FT.SEARCH", REDIS_PLAN_INDEX,
+            f"(@group:{{{self.group_tag(neighbourhood, crime_type)}}})=>[KNN 1 @embedding $vec AS score]",
+            "PARAMS", 2, "vec", vector.astype(np.float32).tobytes(),
+            "RETURN", 2, "score", "plan",
+            "DIALECT", 2
+        )
+        if not result or result[0] == 0:
+            return None
+        fields = dict(zip(result[2][::2], result[2][1::2]))
+        # COSINE distance is 1 - cosine similarity
+        if 1.0 - float(fields[b"score"]) < self.threshold:
+            return None
+        plan = orjson.loads(fields[b"plan"])
+        return SafetyPlan(
+            neighbourhood=plan["neighbourhood"],
+            primary_concerns=plan["primary_concerns"],
+            body=plan["body"],
+            sources=[tuple(source) for source in plan["sources"]],
+            contexts=plan.get("contexts", [])
+        )
+    
+    def add(self, neighbourhood: str, crime_type: List[str], vector: np.ndarray, safety_plan: SafetyPlan) -> None:
+        """Store a generated plan, expiring after the TTL."""
+        self.ensure_index(len(vector))
+        key = f"plan:{uuid.uuid4().hex}"
+        self.client.hset(key, mapping={
+            "group": self.group_tag(neighbourhood, crime_type),
+            "embedding": vector.astype(np.float32).tobytes(),
+            "plan": orjson.dumps({
+                "neighbourhood": safety_plan.neighbourhood,
+                "primary_concerns": safety_plan.primary_concerns,
+                "body": safety_plan.body,
+                "sources": safety_plan.sources,
+                "contexts": safety_plan.contexts
+            })
+        })
+        self.client.expire(key, self.ttl_seconds)
+
+# Functions - Safety Plan Generation
+
+def remove_duplicate_headers(plan_text: str) -> str:
+    """Remove any duplicate headers from the start of the plan text."""
+    return DUPLICATE_HEADER_PATTERN.sub("", plan_text, count=1)
+
+def format_plan_header(neighbourhood: str, formatted_crime_concerns: str) -> str:
+    """Header placed above every safety plan."""
+    return PLAN_HEADER_TEMPLATE.format_map({
+        "neighbourhood": neighbourhood,
+        "primary_concerns": formatted_crime_concerns
+    })
+
+def collect_sources(context: List[Document]) -> List[Tuple[str, str]]:
+    """(title, source) pairs of the retrieved documents, deduplicated in retrieval order."""
+    return list(dict.fromkeys(
+        (doc.metadata.get('title', 'Untitled'), doc.metadata['source'])
+        for doc in context
+    ))
+
+def format_sources(sources: List[Tuple[str, str]]) -> str:
+    """One '- title (source)' line per source."""
+    return "\n".join([f"- {title} ({source})" for title, source in sources])
+
+def format_plan_footer(sources: List[Tuple[str, str]]) -> str:
+    """Sources Consulted section and disclaimer placed below every safety plan."""
+    return PLAN_FOOTER_TEMPLATE.format_map({"sources": format_sources(sources)})
+
+def merge_documents_by_source(docs: List[Document]) -> List[Document]:
+    """
+    Combine chunks retrieved from the same source into a single document, keeping retrieval order.
+    
+    Several chunks of the same page are often retrieved together; merging them means the prompt repeats each source once.
+    At most MAX_RETRIEVED_SOURCES sources are kept, the most relevant ones since documents arrive in retrieval order.
+    """
+    merged = {}
+    for doc in docs:
+        source = doc.metadata["source"]
+        if source in merged:
+            merged[source].page_content += "\n\n" + doc.page_content
+        elif len(merged) < MAX_RETRIEVED_SOURCES:
+            merged[source] = Document(
+                page_content=doc.page_content,
+                metadata={"source": source, "title": doc.metadata.get("title", "Untitled")}
+            )
+    return list(merged.values())
+
+def fit_context(docs: List[Document]) -> List[Document]:
+    """
+    Keep the retrieved documents, in retrieval order, within RETRIEVED_CONTEXT_TOKENS.
+    
+    The separators format_context puts between documents count against the budget too.
+    The document that crosses the budget is truncated to what is left, and any documents after it are dropped.
+    """
+    # A token is at least one byte, so a joined context within the byte bound fits without tokenizing.
+    # That only skips short retrievals: a full set of merged sources is usually over the bound and gets tokenized.
+    if len(format_context(docs).encode()) <= RETRIEVED_CONTEXT_TOKENS:
+        return docs
+    encoding = plan_encoding()
+    separator_tokens = len(encoding.encode(CONTEXT_SEPARATOR))
+    remaining = RETRIEVED_CONTEXT_TOKENS
+    fitted = []
+    for doc in docs:
+        if fitted:
+            remaining -= separator_tokens
+        if remaining <= 0:
+            break
+        tokens = encoding.encode(doc.page_content)
+        if len(tokens) > remaining:
+            doc = Document(page_content=encoding.decode(tokens[:remaining]), metadata=doc.metadata)
+        fitted.append(doc)
+        remaining -= len(tokens)
+    return fitted
+
+@lru_cache(maxsize=1)
+def build_query_embeddings():
+    """
+    Return the embeddings used for retrieval queries and the Pinecone index they search.
+    """
+    bge_index_name = os.getenv("PINECONE_BGE_INDEX_NAME")
+    if bge_index_name:
+        # Imported here so the default path does not need sentence-transformers installed
+        from langchain_huggingface import HuggingFaceEmbeddings
+        embeddings = HuggingFaceEmbeddings(
+            model_name=BGE_MODEL_NAME,
+            model_kwargs={"device": "cpu"},
+            encode_kwargs={"normalize_embeddings": True}
+        )
+        return embeddings, bge_index_name
+    
+    embeddings = QueryEmbeddings(
+        model=EMBEDDING_MODEL,
+        dimensions=EMBEDDING_DIMENSIONS,
+        max_retries=OPENAI_MAX_RETRIES,
+        http_client=HTTP_CLIENT,
+        http_async_client=HTTP_ASYNC_CLIENT
     )
+    return embeddings, PINECONE_INDEX_NAME
+
+@lru_cache(maxsize=1)
+def build_neighbourhood_table(dimensions: int) -> np.ndarray:
+    """
+    Return the normalized embeddings of TORONTO_NEIGHBOURHOODS, one row per name, for query vectors of this length.
+    
+    Loaded from the saved .npy file of the embedding model when its shape matches, otherwise embedded in one call and saved.
+    """
+    embeddings, _ = build_query_embeddings()
+    model = getattr(embeddings, "model", None) or getattr(embeddings, "model_name", None)
+    # The names are part of the key, so editing the neighbourhood list never loads a stale table
+    key = hashlib.sha256(repr((model, getattr(embeddings, "dimensions", None), TORONTO_NEIGHBOURHOODS)).encode()).hexdigest()
+    path = os.path.join(NEIGHBOURHOOD_EMBEDDINGS_DIR, f"neighbourhood_embeddings_{key[:16]}.npy")
+    try:
+        table = np.load(path)
+        if table.shape == (len(TORONTO_NEIGHBOURHOODS), dimensions):
+            return table
+    except (OSError, ValueError):
+        # Missing or unreadable, embed the names again
+        pass
     
-    # Initialize the LLM and the VectorStore retriever
-    retriever = vectorstore.as_retriever(search_kwargs={"k": 10})
-    chat = ChatOpenAI(verbose=True, 
+    table = np.asarray(embeddings.embed_documents(TORONTO_NEIGHBOURHOODS), dtype=np.float32)
+    table /= np.linalg.norm(table, axis=1, keepdims=True)
+    try:
+        os.makedirs(NEIGHBOURHOOD_EMBEDDINGS_DIR, exist_ok=True)
+        np.save(path, table)
+    except OSError:
+        # Not writable, the table is still cached in memory for this process
+        pass
+    return table
+
+def match_neighbourhood(neighbourhood: str, vector: List[float]) -> str:
+    """Closest known neighbourhood name to the embedded input, or the input itself if none is close enough."""
+    scores = build_neighbourhood_table(len(vector)) @ normalize(vector)
+    best = int(np.argmax(scores))
+    if scores[best] >= NEIGHBOURHOOD_MATCH_THRESHOLD:
+        return TORONTO_NEIGHBOURHOODS[best]
+    return neighbourhood
+
+def needs_resolving(neighbourhood: str) -> bool:
+    """Whether the neighbourhood input has to be embedded to find its canonical name."""
+    return bool(NEIGHBOURHOOD_MATCH_THRESHOLD and neighbourhood) and neighbourhood not in KNOWN_NEIGHBOURHOODS
+
+def resolve_neighbourhood(neighbourhood: str) -> str:
+    """Canonical Toronto neighbourhood name for the input, used in the retriever query and the plan header."""
+    if not needs_resolving(neighbourhood):
+        return neighbourhood
+    embeddings, _ = build_query_embeddings()
+    return match_neighbourhood(neighbourhood, embeddings.embed_query(neighbourhood))
+
+def resolve_neighbourhoods(neighbourhoods: List[str]) -> List[str]:
+    """resolve_neighbourhood for a batch, embedding every unknown name in one request."""
+    unknown = list(dict.fromkeys(neighbourhood for neighbourhood in neighbourhoods if needs_resolving(neighbourhood)))
+    if not unknown:
+        return list(neighbourhoods)
+    embeddings, _ = build_query_embeddings()
+    if hasattr(embeddings, "prefetch_queries"):
+        # Cached as queries too, so the single-request path reuses them
+        embeddings.prefetch_queries(unknown)
+        vectors = [embeddings.embed_query(neighbourhood) for neighbourhood in unknown]
+    else:
+        vectors = embeddings.embed_documents(unknown)
+    resolved = {
+        neighbourhood: match_neighbourhood(neighbourhood, vector)
+        for neighbourhood, vector in zip(unknown, vectors)
+    }
+    return [resolved.get(neighbourhood, neighbourhood) for neighbourhood in neighbourhoods]
+
+async def aresolve_neighbourhood(neighbourhood: str) -> str:
+    """Async version of resolve_neighbourhood."""
+    if not needs_resolving(neighbourhood):
+        return neighbourhood
+    embeddings, _ = build_query_embeddings()
+    return match_neighbourhood(neighbourhood, await embeddings.aembed_query(neighbourhood))
+
+def build_chat(model: str) -> ChatOpenAI:
+    """Chat model sharing the process-wide retries, rate limiter and connection pools."""
+    return ChatOpenAI(verbose=DEBUG, 
                       temperature=0.0,
-                      model="gpt-4")
+                      model=model,
+                      max_retries=OPENAI_MAX_RETRIES,
+                      rate_limiter=CHAT_RATE_LIMITER,
+                      http_client=HTTP_CLIENT,
+                      http_async_client=HTTP_ASYNC_CLIENT)
+
+def check_faiss_embeddings(embeddings) -> None:
+    """Raise ValueError unless the FAISS index was built with the same embedding model and dimensions as the queries."""
+    with open(os.path.join(FAISS_INDEX_PATH, FAISS_EMBEDDING_FILE), "rb") as f:
+        built_with = orjson.loads(f.read())
+    query_model = getattr(embeddings, "model", None) or getattr(embeddings, "model_name", None)
+    query_dimensions = getattr(embeddings, "dimensions", None)
+    if (built_with["model"], built_with["dimensions"]) != (query_model, query_dimensions):
+        raise ValueError(
+            f"FAISS index at {FAISS_INDEX_PATH} was built with {built_with['model']} ({built_with['dimensions']} dimensions), "
+            f"but queries are embedded with {query_model} ({query_dimensions} dimensions). "
+            "Rebuild it with modified_ingestion.py --faiss using the same EMBEDDING_MODEL and EMBEDDING_DIMENSIONS."
+        )
+
+@lru_cache(maxsize=1)
+def build_retrieval_chain():
+    """
+    Build the chain that retrieves documents for the user input, merging chunks from the same source.
+    """
+    # Initialize components
+    embeddings, index_name = build_query_embeddings()
+    if FAISS_INDEX_PATH:
+        # Imported here so the default path does not need faiss installed
+        from langchain_community.vectorstores import FAISS
+        from langchain_community.vectorstores.utils import DistanceStrategy
+        check_faiss_embeddings(embeddings)
+        # The index is written by our own ingestion script, so loading its pickled docstore is safe
+        vectorstore = FAISS.load_local(
+            FAISS_INDEX_PATH,
+            embeddings,
+            allow_dangerous_deserialization=True,
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+        )
+    elif PINECONE_USE_GRPC:
+        # Imported here so the default path does not need the gRPC extras installed
+        from pinecone.grpc import PineconeGRPC
+        index = PineconeGRPC(api_key=os.environ["PINECONE_API_KEY"]).Index(index_name)
+        vectorstore = PineconeVectorStore(
+            index=index,
+            embedding=embeddings
+        )
+    else:
+        vectorstore = PineconeVectorStore(
+            index_name=index_name,
+            embedding=embeddings
+        )
     
-    # Create the analysis chain
-    analysis_chain = create_retrieval_chain(
-        retriever=retriever,
-        combine_docs_chain=create_stuff_documents_chain(
-            llm=chat,
-            prompt=FIRST_SAFETY_PROMPT
+    # Initialize the VectorStore retriever
+    if RERANK_MODEL:
+        retriever = ContextualCompressionRetriever(
+            base_compressor=PineconeRerank(model=RERANK_MODEL, top_n=RERANK_TOP_N),
+            base_retriever=vectorstore.as_retriever(search_kwargs={"k": RERANK_FETCH_K})
+        )
+    else:
+        retriever = vectorstore.as_retriever(
+            search_type=RETRIEVER_SEARCH_TYPE,
+            search_kwargs=RETRIEVER_SEARCH_KWARGS
         )
-    )
     
-    # Create the plan generation chain using LCEL
-    plan_prompt = SECOND_SAFETY_PROMPT
-    plan_chain = (
-        {
-            "input": lambda x: x["input"],
-            "analysis": lambda x: x["analysis"],
-            "example_safety_plans": lambda x: x["example_safety_plans"]
-        } |
-        plan_prompt | 
-        chat | 
-        StrOutputParser()
+    # Retry transient Pinecone errors so a failed lookup does not drop the whole request
+    retriever = retriever.with_retry(
+        wait_exponential_jitter=True,
+        stop_after_attempt=RETRIEVER_MAX_ATTEMPTS
     )
     
-    def remove_duplicate_headers(plan_text: str) -> str:
-        """Remove any duplicate headers from the plan text."""
-        # Remove any instances of the header if found in the plan
-        header_patterns = [
-            r"CITY OF TORONTO SERVICE SAFETY PLAN\s*",
-            r"Neighbourhood:[^\\n]*\s*",
-            r"Primary Concerns:[^\\n]*\s*"
-        ]
-        cleaned_text = plan_text
-        for pattern in header_patterns:
-            cleaned_text = re.sub(pattern, "", cleaned_text)
-        return cleaned_text
-    
-    # Create a chain using LCEL syntax with complete plan formatting
-    safety_plan_chain = (
-        analysis_chain | 
-        {
-            "input": itemgetter("input"),
-            "analysis": itemgetter("answer"),
-            "example_safety_plans": lambda _: "\n\n".join(
-                f"=== EXAMPLE: {name} ===\n{example}" 
-                for name, example in safety_plan_examples
-            ),
-            "context": itemgetter("context")
-        } | 
-        {
-            "plan": plan_chain,
-            "context": itemgetter("context")
-        } |
-        # Add headers programmatically and clean up any duplicates
-        (lambda x: {
-            "final_plan": f"""CITY OF TORONTO SERVICE SAFETY PLAN
-Neighbourhood: {neighbourhood}
-Primary Concerns: {formatted_crime_concerns}
+    if RETRIEVER_PER_CONCERN:
+        # .map() runs the concern queries as one batch, in parallel threads or concurrently on the event loop
+        return (
+            RunnableLambda(concern_queries) |
+            retriever.map() |
+            RunnableLambda(fuse_rankings) |
+            RunnableLambda(merge_documents_by_source) |
+            RunnableLambda(fit_context)
+        )
+    
+    # Retrieve documents for the user input, merging chunks from the same source
+    return itemgetter("input") | retriever | RunnableLambda(merge_documents_by_source) | RunnableLambda(fit_context)
+
+def concern_queries(chain_input: Dict) -> List[str]:
+    """One retrieval query per crime concern, e.g. "Assault: High in Annex (95)"."""
+    return [
+        f"{concern} in {chain_input['neighbourhood']}"
+        for concern in chain_input["crime_type"]
+    ]
 
-{remove_duplicate_headers(x["plan"])}
+def retrieval_queries(chain_input: Dict) -> List[str]:
+    """The queries the retrieval chain embeds for this input."""
+    if RETRIEVER_PER_CONCERN:
+        return concern_queries(chain_input)
+    return [chain_input["input"]]
 
-Sources Consulted:
-{chr(10).join([f"- {title} ({source})" for title, source in {
-    (doc.metadata.get('title', 'Untitled'), doc.metadata['source'])
-    for doc in x["context"]
-}])}
+def fuse_rankings(rankings: List[List[Document]]) -> List[Document]:
+    """
+    Merge several retrieval rankings with reciprocal rank fusion: each document scores 1 / (RRF_K + rank) per ranking.
+    
+    Returns as many documents as a single query retrieves, best first.
+    """
+    scores = {}
+    docs = {}
+    for ranking in rankings:
+        for rank, doc in enumerate(ranking, start=1):
+            key = (doc.metadata["source"], doc.page_content)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (RRF_K + rank)
+            docs.setdefault(key, doc)
+    top_k = RERANK_TOP_N if RERANK_MODEL else RETRIEVER_SEARCH_KWARGS["k"]
+    return [docs[key] for key in sorted(scores, key=scores.get, reverse=True)[:top_k]]
+
+def format_context(docs: List[Document]) -> str:
+    """Join the retrieved documents into the {context} block of a prompt."""
+    return CONTEXT_SEPARATOR.join(doc.page_content for doc in docs)
+
+def build_analysis_chain(retrieval_chain, llm, prompt: ChatPromptTemplate, parser=None):
+    """
+    Retrieve documents for the chain input and answer the prompt over them.
+    
+    The output is the chain input plus "context" (the retrieved documents) and "answer" (the parsed LLM response),
+    the same shape create_retrieval_chain returns, but the documents are joined into the prompt context once.
+    "sources" holds the Sources Consulted entries, collected from the documents while the LLM call runs.
+    """
+    answer_chain = (
+        RunnableLambda(lambda x: {**x, "context": format_context(x["context"])}) |
+        prompt |
+        llm |
+        (parser or StrOutputParser())
+    )
+    return RunnablePassthrough.assign(context=retrieval_chain).assign(
+        sources=lambda x: collect_sources(x["context"]),
+        answer=answer_chain
+    )
 
-----
+@lru_cache(maxsize=1)
+def build_chains():
+    """
+    Build the plan chat model, the analysis chain (retrieval + first prompt) and the plan chain (second prompt).
+    
+    Built once on first use and shared by every call, so clients, connection pools and chains are not recreated per request.
+    """
+    analysis_chat = build_chat(ANALYSIS_MODEL)
+    chat = build_chat(PLAN_MODEL)
+    retrieval_chain = build_retrieval_chain()
+    
+    # Create the analysis chain
+    analysis_chain = build_analysis_chain(retrieval_chain, analysis_chat, FIRST_SAFETY_PROMPT)
+    
+    # Create the plan generation chain using LCEL
+    plan_prompt = SECOND_SAFETY_PROMPT
+    plan_chain = plan_prompt | chat | StrOutputParser()
+    
+    if PLAN_OUTPUT_FORMAT == "json":
+        # The response is validated against SafetyPlanSections, so no string parsing of the markdown is needed
+        plan_chain = (
+            plan_prompt |
+            chat.with_structured_output(SafetyPlanSections, method="json_schema", strict=True) |
+            RunnableLambda(render_plan_sections)
+        )
+    
+    return chat, analysis_chain, plan_chain
+
+def render_plan_sections(sections: SafetyPlanSections) -> str:
+    """Render structured plan sections into the plan body with a single format_map."""
+    return PLAN_SECTIONS_TEMPLATE.format_map({
+        "assessment": sections.assessment,
+        "recommendations": "\n\n".join(
+            f"{item.concern}:\n{item.recommendations}" for item in sections.recommendations
+        ),
+        "protocol": sections.protocol,
+        "preventive": sections.preventive
+    })
+
+@lru_cache(maxsize=1)
+def build_safety_plan_chain():
+    """
+    Build the full safety plan chain once: analysis, then plan generation, then assembly into a SafetyPlan.
+    
+    The neighbourhood and primary concerns are passed through from the chain input, so the same chain serves every request.
+    """
+    chat, analysis_chain, plan_chain = build_chains()
+    
+    if SINGLE_PASS:
+        # One LLM call writes the analysis and the plan, only the plan is kept
+        if PLAN_OUTPUT_FORMAT != "json":
+            fused_chain = build_analysis_chain(build_retrieval_chain(), chat, FUSED_SAFETY_PROMPT)
+        else:
+            # The analysis and plan sections come back as schema-validated fields, so no tags need to be parsed
+            fused_chain = build_analysis_chain(
+                build_retrieval_chain(),
+                chat.with_structured_output(FusedSafetyPlanSections, method="json_schema", strict=True),
+                FUSED_JSON_SAFETY_PROMPT,
+                parser=RunnableLambda(lambda fused: render_plan_sections(fused.plan))
+            )
+        return fused_chain | (lambda x: SafetyPlan(
+            neighbourhood=x["neighbourhood"],
+            primary_concerns=x["primary_concerns"],
+            body=remove_duplicate_headers(extract_plan(x["answer"])),
+            sources=x["sources"],
+            contexts=[doc.page_content for doc in x["context"]]
+        ))
+    
+    def plan_inputs(analysis_result: Dict) -> Dict[str, str]:
+        return {
+            "input": analysis_result["input"],
+            "analysis": analysis_result["answer"]
+        }
+    
+    def to_safety_plan(analysis_result: Dict, plan: str) -> SafetyPlan:
+        # Clean up any duplicate headers, the header and footer are added when the plan is rendered
+        return SafetyPlan(
+            neighbourhood=analysis_result["neighbourhood"],
+            primary_concerns=analysis_result["primary_concerns"],
+            body=remove_duplicate_headers(plan),
+            sources=analysis_result["sources"],
+            contexts=[doc.page_content for doc in analysis_result["context"]]
+        )
+    
+    # One step runs the plan chain on the analysis and assembles the SafetyPlan.
+    # Passing the config on keeps the plan call nested under this step in LangSmith traces.
+    def write_plan(analysis_result: Dict, config: RunnableConfig) -> SafetyPlan:
+        return to_safety_plan(analysis_result, plan_chain.invoke(plan_inputs(analysis_result), config=config))
+    
+    async def awrite_plan(analysis_result: Dict, config: RunnableConfig) -> SafetyPlan:
+        plan = await plan_chain.ainvoke(plan_inputs(analysis_result), config=config)
+        return to_safety_plan(analysis_result, plan)
+    
+    return analysis_chain | RunnableLambda(write_plan, afunc=awrite_plan, name="write_safety_plan")
 
-Note: This safety plan is generated based on Toronto Police Service resources and general 
-safety guidelines. For emergencies, always call 911. For non-emergency police matters, 
-call 416-808-2222.
-"""
-        })
-    )
+def extract_plan(response: str) -> str:
+    """Return the plan that follows the <analysis> block of a single-pass response."""
+    match = ANALYSIS_BLOCK_PATTERN.search(response)
+    if match is None:
+        return response
+    return response[match.end():].lstrip()
+
+def pair_user_context(user_context: Union[List[str], List[Tuple[str, str]]]) -> List[Tuple[str, str]]:
+    """
+    Pair up the survey questions and answers in user_context.
     
-    # Format the input
-    formatted_user_input = {
-        "input": f"""
-        LOCATION: {neighbourhood}
-        
-        SAFETY CONCERNS:
-        - {formatted_crime_concerns}
-        
-        ADDITIONAL USER CONTEXT:
-        {formatted_context}
-        """
+    Accepts (question, answer) tuples, or the survey's flat list of alternating "Q: ..." and "A: ..." lines.
+    """
+    if user_context and not isinstance(user_context[0], str):
+        return [tuple(pair) for pair in user_context]
+    questions = [line.removeprefix("Q:").strip() for line in user_context[::2]]
+    answers = [line.removeprefix("A:").strip() for line in user_context[1::2]]
+    return list(zip_longest(questions, answers, fillvalue=""))
+
+def format_user_context(user_context: Union[List[str], List[Tuple[str, str]]]) -> str:
+    """Format the user's survey answers as Q/A pairs for the prompt."""
+    return "\n".join(f"Q: {question}\nA: {answer}" for question, answer in pair_user_context(user_context))
+
+@lru_cache(maxsize=1)
+def plan_encoding() -> tiktoken.Encoding:
+    """Tokenizer of the plan model, loaded on first use."""
+    try:
+        return tiktoken.encoding_for_model(PLAN_MODEL)
+    except KeyError:
+        return tiktoken.get_encoding("o200k_base")
+
+@lru_cache(maxsize=1)
+def user_context_token_budget() -> Tuple[tiktoken.Encoding, int]:
+    """Tokenizer of the plan model and the exact number of tokens left for the user context in every prompt."""
+    encoding = plan_encoding()
+    static_tokens = max(len(encoding.encode(text)) for text in STATIC_PROMPT_TEXTS)
+    return encoding, PROMPT_TOKEN_BUDGET - RETRIEVED_CONTEXT_TOKENS - 2 * OUTPUT_RESERVE_TOKENS - static_tokens
+
+def fit_user_context(formatted_context: str) -> str:
+    """Cut the formatted user context to the prompt token budget, so an oversized request fails neither OpenAI call."""
+    # A token is at least one byte, so anything within the byte bound fits without tokenizing
+    if len(formatted_context.encode()) <= USER_CONTEXT_MIN_BUDGET:
+        return formatted_context
+    encoding, budget = user_context_token_budget()
+    tokens = encoding.encode(formatted_context)
+    if len(tokens) <= budget:
+        return formatted_context
+    return encoding.decode(tokens[:max(budget, 0)])
+
+def format_user_input(neighbourhood: str, formatted_crime_concerns: str, formatted_context: str) -> Dict[str, str]:
+    """Format the user's request into the input for the analysis chain."""
+    return {
+        "input": USER_INPUT_TEMPLATE.format_map({
+            "neighbourhood": neighbourhood,
+            "primary_concerns": formatted_crime_concerns,
+            "user_context": formatted_context
+        }),
+        "neighbourhood": neighbourhood,
+        "primary_concerns": formatted_crime_concerns
     }
+
+def build_chain_input(
+    neighbourhood: str,
+    crime_type: List[str],
+    user_context: Union[List[str], List[Tuple[str, str]]]
+    ) -> Dict:
+    """
+    Format the crime concerns and user context into the input for the safety plan chain.
+    
+    The crime concerns are also passed through as a list, for the per-concern retrieval queries.
+    """
+    formatted_crime_concerns = ", ".join(crime_type)
+    formatted_context = fit_user_context(format_user_context(user_context))
+    return {**format_user_input(neighbourhood, formatted_crime_concerns, formatted_context), "crime_type": list(crime_type)}
+
+# Generated plans, keyed by the formatted user request.
+# Batches read and write it from thread pools, so every access holds the lock.
+plan_cache: OrderedDict = OrderedDict()
+plan_cache_lock = threading.Lock()
+
+def get_cached_plan(chain_input: Dict[str, str]) -> Union[SafetyPlan, None]:
+    """Return the stored plan for this request, marking it as recently used."""
+    key = chain_input["input"]
+    with plan_cache_lock:
+        safety_plan = plan_cache.get(key)
+        if safety_plan is not None:
+            plan_cache.move_to_end(key)
+    return safety_plan
+
+def cache_plan(chain_input: Dict[str, str], safety_plan: SafetyPlan) -> None:
+    """Store a generated plan, evicting the least recently used one when full."""
+    with plan_cache_lock:
+        plan_cache[chain_input["input"]] = safety_plan
+        if len(plan_cache) > PLAN_CACHE_SIZE:
+            plan_cache.popitem(last=False)
+
+def generic_safety_plan(neighbourhood: str, crime_type: List[str]) -> Union[SafetyPlan, None]:
+    """Return the general plan when the request has no neighbourhood or no crime concerns, otherwise None."""
+    if neighbourhood and crime_type:
+        return None
+    return SafetyPlan(
+        neighbourhood=neighbourhood or "Not specified",
+        primary_concerns=", ".join(crime_type) or "None specified",
+        body=GENERIC_PLAN_BODY,
+        sources=GENERIC_PLAN_SOURCES
+    )
+
+# Plans for similar requests, used when SEMANTIC_CACHE_THRESHOLD is set
+if REDIS_URL:
+    semantic_plan_cache = RedisPlanCache(REDIS_URL, SEMANTIC_CACHE_THRESHOLD, REDIS_PLAN_TTL_SECONDS)
+else:
+    semantic_plan_cache = SemanticPlanCache(SEMANTIC_CACHE_THRESHOLD, PLAN_CACHE_SIZE)
+
+def semantic_cache_text(user_context: Union[List[str], List[Tuple[str, str]]]) -> str:
+    """Normalized user context answers embedded for the semantic cache."""
+    return " ".join(f"{question} {answer}" for question, answer in pair_user_context(user_context)).lower()
+
+def normalize(vector: List[float]) -> np.ndarray:
+    """Unit-length vector, so a dot product gives cosine similarity."""
+    array = np.asarray(vector, dtype=np.float32)
+    return array / (np.linalg.norm(array) or 1.0)
+
+async def alookup_semantic_plan(
+    neighbourhood: str,
+    crime_type: List[str],
+    user_context: Union[List[str], List[Tuple[str, str]]]
+    ) -> Tuple[Union[SafetyPlan, None], Union[np.ndarray, None]]:
+    """
+    Semantic cache lookup for the async entry points.
     
-    # Run the chain
-    chain_result = safety_plan_chain.invoke(
-    formatted_user_input,
-    config={
+    Returns the plan found (or None) and the context vector a newly generated plan is stored under (None when the cache is off).
+    """
+    if not SEMANTIC_CACHE_THRESHOLD:
+        return None, None
+    embeddings, _ = build_query_embeddings()
+    context_vector = normalize(await embeddings.aembed_query(semantic_cache_text(user_context)))
+    if REDIS_URL:
+        # redis-py calls block, so they run in a worker thread instead of stalling every request on the event loop
+        safety_plan = await asyncio.to_thread(semantic_plan_cache.lookup, neighbourhood, crime_type, context_vector)
+    else:
+        safety_plan = semantic_plan_cache.lookup(neighbourhood, crime_type, context_vector)
+    return safety_plan, context_vector
+
+async def aadd_semantic_plan(neighbourhood: str, crime_type: List[str], vector: np.ndarray, safety_plan: SafetyPlan) -> None:
+    """semantic_plan_cache.add for the async entry points, off the event loop when the cache is in Redis."""
+    if REDIS_URL:
+        await asyncio.to_thread(semantic_plan_cache.add, neighbourhood, crime_type, vector, safety_plan)
+    else:
+        semantic_plan_cache.add(neighbourhood, crime_type, vector, safety_plan)
+
+def build_run_config(chat: ChatOpenAI) -> Dict:
+    """LangSmith tags attached to every safety plan run."""
+    return {
         "tags": [
             "application_example", 
             "one_shot_example",
             "trinity_bellwoods_york_examples",
-            f"model_{chat.model_name}"
+            f"model_{chat.model_name}",
+            f"analysis_model_{ANALYSIS_MODEL}"
         ],
     }
-    ) 
 
-    # Put it into a plan_string.
-    # This new format should allow us to see the full plan in LangSmith traces.
-    plan_string = chain_result["final_plan"]
+def generate_safety_plan(
+    neighbourhood: str,
+    crime_type: List[str],
+    user_context: Union[List[str], List[Tuple[str, str]]],
+    structured: bool = False
+    ) -> Union[str, SafetyPlan]:
+    
+    """
+    This code generates a safety plan based on specific neighbourhood and crime concerns.
+    
+    Chain of Thought is implemented, where the LLM is (1) Prompted to provide a detailed analysis considering only the information provided above, and (2) Prompted to provide a comprehensive and actionable safety plan that addresses the user's concerns and enhances their safety, in the City of Toronto.
+    
+    Returns the formatted plan as a string, or the SafetyPlan itself if structured is True.
+    """
+    
+    # Nothing to retrieve for an empty request, skip the chain
+    safety_plan = generic_safety_plan(neighbourhood, crime_type)
+    if safety_plan is not None:
+        return safety_plan if structured else str(safety_plan)
+    
+    neighbourhood = resolve_neighbourhood(neighbourhood)
+    chain_input = build_chain_input(neighbourhood, crime_type, user_context)
+    safety_plan = get_cached_plan(chain_input)
+    
+    # Near-identical requests can reuse a plan when the semantic cache is enabled
+    context_vector = None
+    if safety_plan is None and SEMANTIC_CACHE_THRESHOLD:
+        embeddings, _ = build_query_embeddings()
+        context_vector = normalize(embeddings.embed_query(semantic_cache_text(user_context)))
+        safety_plan = semantic_plan_cache.lookup(neighbourhood, crime_type, context_vector)
+    
+    if safety_plan is None:
+        chat, _, _ = build_chains()
+        safety_plan_chain = build_safety_plan_chain()
+        
+        # Run the chain
+        safety_plan = safety_plan_chain.invoke(
+        chain_input,
+        config=build_run_config(chat)
+        ) 
+        cache_plan(chain_input, safety_plan)
+        if context_vector is not None:
+            semantic_plan_cache.add(neighbourhood, crime_type, context_vector, safety_plan)
+
+    if structured:
+        return safety_plan
     
     # Return the final formatted plan
-    return plan_string
+    return str(safety_plan)
+
+async def agenerate_safety_plan(
+    neighbourhood: str,
+    crime_type: List[str],
+    user_context: Union[List[str], List[Tuple[str, str]]],
+    structured: bool = False
+    ) -> Union[str, SafetyPlan]:
+    
+    """
+    Async version of generate_safety_plan.
+    
+    Retrieval and both LLM calls are awaited instead of blocking, so many plans can be generated concurrently on one event loop.
+    """
+    
+    # Nothing to retrieve for an empty request, skip the chain
+    safety_plan = generic_safety_plan(neighbourhood, crime_type)
+    if safety_plan is not None:
+        return safety_plan if structured else str(safety_plan)
+    
+    neighbourhood = await aresolve_neighbourhood(neighbourhood)
+    chain_input = build_chain_input(neighbourhood, crime_type, user_context)
+    safety_plan = get_cached_plan(chain_input)
+    
+    # Near-identical requests can reuse a plan when the semantic cache is enabled
+    context_vector = None
+    if safety_plan is None:
+        safety_plan, context_vector = await alookup_semantic_plan(neighbourhood, crime_type, user_context)
+    
+    if safety_plan is None:
+        chat, _, _ = build_chains()
+        safety_plan_chain = build_safety_plan_chain()
+        
+        safety_plan = await safety_plan_chain.ainvoke(
+            chain_input,
+            config=build_run_config(chat)
+        )
+        cache_plan(chain_input, safety_plan)
+        if context_vector is not None:
+            await aadd_semantic_plan(neighbourhood, crime_type, context_vector, safety_plan)
+    
+    if structured:
+        return safety_plan
+    return str(safety_plan)
+
+def lookup_batch(inputs: List[Dict]) -> Tuple[List[Dict[str, str]], List[Union[SafetyPlan, None]], List[int]]:
+    """
+    Format every request in a batch and fill in the plans that need no LLM calls.
+    
+    Returns the chain inputs, the plans found so far (None where missing) and the positions still to generate.
+    """
+    chain_inputs = [build_chain_input(**request) for request in inputs]
+    safety_plans = [
+        generic_safety_plan(request["neighbourhood"], request["crime_type"]) or get_cached_plan(chain_input)
+        for request, chain_input in zip(inputs, chain_inputs)
+    ]
+    missing = [i for i, safety_plan in enumerate(safety_plans) if safety_plan is None]
+    return chain_inputs, safety_plans, missing
+
+def build_batch_config(concurrency: int) -> Dict:
+    """Run config for a batch, capping the number of requests in flight."""
+    chat, _, _ = build_chains()
+    config = build_run_config(chat)
+    config["max_concurrency"] = concurrency
+    return config
+
+def store_batch(chain_inputs, safety_plans, missing, generated, structured: bool) -> List[Union[str, SafetyPlan]]:
+    """Put the generated plans in input order, cache them and format the batch result."""
+    for i, safety_plan in zip(missing, generated):
+        safety_plans[i] = safety_plan
+        cache_plan(chain_inputs[i], safety_plan)
+    
+    if structured:
+        return safety_plans
+    return [str(safety_plan) for safety_plan in safety_plans]
+
+def generate_safety_plans(
+    inputs: List[Dict],
+    concurrency: int = 8,
+    structured: bool = False
+    ) -> List[Union[str, SafetyPlan]]:
+    
+    """
+    Generate safety plans for many requests in parallel threads, for synchronous callers such as the evaluation scripts.
+    
+    Each input is a dict with neighbourhood, crime_type and user_context, as taken by generate_safety_plan.
+    At most concurrency requests are in flight at once, and plans are returned in input order.
+    """
+    
+    neighbourhoods = resolve_neighbourhoods([request["neighbourhood"] for request in inputs])
+    inputs = [{**request, "neighbourhood": neighbourhood} for request, neighbourhood in zip(inputs, neighbourhoods)]
+    chain_inputs, safety_plans, missing = lookup_batch(inputs)
+    
+    # Only generate the plans that are not cached yet
+    generated = []
+    if missing:
+        # The batch runs in threads, so embed every retrieval query in one request up front for them to read from the cache.
+        # The async batch does not need this, QueryEmbeddings already groups concurrent aembed_query calls
+        embeddings, _ = build_query_embeddings()
+        if hasattr(embeddings, "prefetch_queries"):
+            embeddings.prefetch_queries([query for i in missing for query in retrieval_queries(chain_inputs[i])])
+        generated = build_safety_plan_chain().batch(
+            [chain_inputs[i] for i in missing],
+            config=build_batch_config(concurrency)
+        )
+    
+    return store_batch(chain_inputs, safety_plans, missing, generated, structured)
+
+async def generate_safety_plans_batch(
+    inputs: List[Dict],
+    concurrency: int = 8,
+    structured: bool = False
+    ) -> List[Union[str, SafetyPlan]]:
+    
+    """
+    Generate safety plans for many requests concurrently, e.g. every neighbourhood in an evaluation set.
+    
+    Each input is a dict with neighbourhood, crime_type and user_context, as taken by generate_safety_plan.
+    At most concurrency requests are in flight at once, and plans are returned in input order.
+    """
+    
+    neighbourhoods = await asyncio.gather(*(aresolve_neighbourhood(request["neighbourhood"]) for request in inputs))
+    inputs = [{**request, "neighbourhood": neighbourhood} for request, neighbourhood in zip(inputs, neighbourhoods)]
+    chain_inputs, safety_plans, missing = lookup_batch(inputs)
+    
+    # Only generate the plans that are not cached yet
+    generated = []
+    if missing:
+        generated = await build_safety_plan_chain().abatch(
+            [chain_inputs[i] for i in missing],
+            config=build_batch_config(concurrency)
+        )
+    
+    return store_batch(chain_inputs, safety_plans, missing, generated, structured)
+
+def streamed_body_start(text: str) -> Union[str, None]:
+    """
+    Cleaned start of a streamed plan response, or None while more text could still change it.
+    
+    Single-pass responses are held back until their analysis block is closed, and every response until a complete line
+    follows any duplicate headers, so the cleanup gives exactly what clean_plan_response gives for the whole response.
+    """
+    if SINGLE_PASS:
+        match = ANALYSIS_BLOCK_PATTERN.search(text)
+        if match is None:
+            return None
+        text = text[match.end():].lstrip()
+    headers = DUPLICATE_HEADER_PATTERN.match(text)
+    if "\n" not in (text[headers.end():] if headers else text.lstrip()):
+        return None
+    return remove_duplicate_headers(text)
+
+def clean_plan_response(response: str) -> str:
+    """Plan body of a complete markdown plan response: the analysis block of single-pass responses and duplicate headers removed."""
+    return remove_duplicate_headers(extract_plan(response) if SINGLE_PASS else response)
+
+async def generate_safety_plan_stream(
+    neighbourhood: str,
+    crime_type: List[str],
+    user_context: Union[List[str], List[Tuple[str, str]]],
+    ) -> AsyncIterator[str]:
+    
+    """
+    Streaming version of generate_safety_plan, yielding the safety plan as it is generated.
+    
+    The header is yielded straight away, the plan body is streamed token by token from the LLM call that writes it, and the Sources Consulted footer is yielded last. Joining every chunk gives the same plan as generate_safety_plan, and the plan is cached the same way.
+    """
+    
+    # Nothing to retrieve for an empty request, skip the chain
+    safety_plan = generic_safety_plan(neighbourhood, crime_type)
+    if safety_plan is not None:
+        yield str(safety_plan)
+        return
+    
+    neighbourhood = await aresolve_neighbourhood(neighbourhood)
+    chain_input = build_chain_input(neighbourhood, crime_type, user_context)
+    
+    # A cached plan is already complete, send it in one piece
+    safety_plan = get_cached_plan(chain_input)
+    context_vector = None
+    if safety_plan is None:
+        safety_plan, context_vector = await alookup_semantic_plan(neighbourhood, crime_type, user_context)
+    if safety_plan is not None:
+        yield str(safety_plan)
+        return
+    
+    chat, analysis_chain, _ = build_chains()
+    config = build_run_config(chat)
+    
+    # Header does not depend on the LLM, so the user sees it immediately
+    yield format_plan_header(neighbourhood, chain_input["primary_concerns"])
+    
+    if PLAN_OUTPUT_FORMAT == "json":
+        # Partial JSON is not readable, so the structured plan body is yielded once it is complete
+        safety_plan = await build_safety_plan_chain().ainvoke(chain_input, config=config)
+        yield safety_plan.body
+        yield format_plan_footer(safety_plan.sources)
+    else:
+        if SINGLE_PASS:
+            # Retrieve, then stream the single LLM call that writes the analysis and the plan
+            context = await build_retrieval_chain().ainvoke(chain_input, config=config)
+            plan_prompt = FUSED_SAFETY_PROMPT.format_messages(input=chain_input["input"], context=format_context(context))
+            sources = collect_sources(context)
+        else:
+            # Run the analysis chain (retrieval + first LLM call), then stream the second prompt from the chat model
+            analysis_result = await analysis_chain.ainvoke(chain_input, config=config)
+            context = analysis_result["context"]
+            plan_prompt = SECOND_SAFETY_PROMPT.format_messages(
+                input=analysis_result["input"],
+                analysis=analysis_result["answer"]
+            )
+            sources = analysis_result["sources"]
+        
+        # Body chunks are kept so the finished plan can be cached.
+        # The start of the response is held back until its cleanup is settled, the rest is streamed as it arrives.
+        response = ""
+        body_parts = []
+        async for message_chunk in chat.astream(plan_prompt, config=config):
+            chunk = message_chunk.content
+            if body_parts:
+                body_parts.append(chunk)
+                yield chunk
+                continue
+            response += chunk
+            body_start = streamed_body_start(response)
+            if body_start is not None:
+                body_parts.append(body_start)
+                yield body_start
+        if not body_parts:
+            body_parts.append(clean_plan_response(response))
+            yield body_parts[-1]
+        
+        # Sources are known since retrieval, so the footer is ready as soon as the plan ends
+        yield format_plan_footer(sources)
+        
+        safety_plan = SafetyPlan(
+            neighbourhood=neighbourhood,
+            primary_concerns=chain_input["primary_concerns"],
+            body="".join(body_parts),
+            sources=sources,
+            contexts=[doc.page_content for doc in context]
+        )
+    
+    cache_plan(chain_input, safety_plan)
+    if context_vector is not None:
+        await aadd_semantic_plan(neighbourhood, crime_type, context_vector, safety_plan)
+
+async def collect(stream: AsyncIterator[str]) -> str:
+    """Join a streamed safety plan back into one string, for batch use such as the evaluation scripts."""
+    return "".join([chunk async for chunk in stream])
 
 # Main Control to run function:
 if __name__ == "__main__":
@@ -542,4 +1668,7 @@ if __name__ == "__main__":
     )
 
     # Print the result
-    print(result) 
\ No newline at end of file
+    print(result)
+    
+    # Traces are sent in the background, make sure they are flushed before exiting
+    wait_for_all_tracers()
@@ -0,0 +1,167 @@
+"""
+neighbourhoods.py
+PURPOSE: The Toronto neighbourhood names (with their neighbourhood numbers) used by the safety plan generator and the evaluation scripts.
+
+main.py resolves free-form neighbourhood input to one of these names before retrieval.
+"""
+
+# Toronto Neighbourhoods:
+TORONTO_NEIGHBOURHOODS = [
+    "Agincourt North (129)",
+    "Agincourt South-Malvern West (128)",
+    "Alderwood (20)",
+    "Annex (95)",
+    "Avondale (153)",
+    "Banbury-Don Mills (42)",
+    "Bathurst Manor (34)",
+    "Bay-Cloverhill (169)",
+    "Bayview Village (52)",
+    "Bayview Woods-Steeles (49)",
+    "Bedford Park-Nortown (39)",
+    "Beechborough-Greenbrook (112)",
+    "Bendale South (157)",
+    "Bendale-Glen Andrew (156)",
+    "Birchcliffe-Cliffside (122)",
+    "Black Creek (24)",
+    "Blake-Jones (69)",
+    "Briar Hill-Belgravia (108)",
+    "Bridle Path-Sunnybrook-York Mills (41)",
+    "Broadview North (57)",
+    "Brookhaven-Amesbury (30)",
+    "Cabbagetown-South St.James Town (71)",
+    "Caledonia-Fairbank (109)",
+    "Casa Loma (96)",
+    "Centennial Scarborough (133)",
+    "Church-Wellesley (167)",
+    "Clairlea-Birchmount (120)",
+    "Clanton Park (33)",
+    "Cliffcrest (123)",
+    "Corso Italia-Davenport (92)",
+    "Danforth (66)",
+    "Danforth East York (59)",
+    "Don Valley Village (47)",
+    "Dorset Park (126)",
+    "Dovercourt Village (172)",
+    "Downsview (155)",
+    "Downtown Yonge East (168)",
+    "Dufferin Grove (83)",
+    "East End-Danforth (62)",
+    "East L'Amoreaux (148)",
+    "East Willowdale (152)",
+    "Edenbridge-Humber Valley (9)",
+    "Eglinton East (138)",
+    "Elms-Old Rexdale (5)",
+    "Englemount-Lawrence (32)",
+    "Eringate-Centennial-West Deane (11)",
+    "Etobicoke City Centre (159)",
+    "Etobicoke West Mall (13)",
+    "Fenside-Parkwoods (150)",
+    "Flemingdon Park (44)",
+    "Forest Hill North (102)",
+    "Forest Hill South (101)",
+    "Fort York-Liberty Village (163)",
+    "Glenfield-Jane Heights (25)",
+    "Golfdale-Cedarbrae-Woburn (141)",
+    "Greenwood-Coxwell (65)",
+    "Guildwood (140)",
+    "Harbourfront-CityPlace (165)",
+    "Henry Farm (53)",
+    "High Park North (88)",
+    "High Park-Swansea (87)",
+    "Highland Creek (134)",
+    "Hillcrest Village (48)",
+    "Humber Bay Shores (161)",
+    "Humber Heights-Westmount (8)",
+    "Humber Summit (21)",
+    "Humbermede (22)",
+    "Humewood-Cedarvale (106)",
+    "Ionview (125)",
+    "Islington (158)",
+    "Junction Area (90)",
+    "Junction-Wallace Emerson (171)",
+    "Keelesdale-Eglinton West (110)",
+    "Kennedy Park (124)",
+    "Kensington-Chinatown (78)",
+    "Kingsview Village-The Westway (6)",
+    "Kingsway South (15)",
+    "Lambton Baby Point (114)",
+    "L'Amoreaux West (147)",
+    "Lansing-Westgate (38)",
+    "Lawrence Park North (105)",
+    "Lawrence Park South (103)",
+    "Leaside-Bennington (56)",
+    "Little Portugal (84)",
+    "Long Branch (19)",
+    "Malvern East (146)",
+    "Malvern West (145)",
+    "Maple Leaf (29)",
+    "Markland Wood (12)",
+    "Milliken (130)",
+    "Mimico-Queensway (160)",
+    "Morningside (135)",
+    "Morningside Heights (144)",
+    "Moss Park (73)",
+    "Mount Dennis (115)",
+    "Mount Olive-Silverstone-Jamestown (2)",
+    "Mount Pleasant East (99)",
+    "New Toronto (18)",
+    "Newtonbrook East (50)",
+    "Newtonbrook West (36)",
+    "North Riverdale (68)",
+    "North St.James Town (74)",
+    "North Toronto (173)",
+    "Oakdale-Beverley Heights (154)",
+    "Oakridge (121)",
+    "Oakwood Village (107)",
+    "O'Connor-Parkview (54)",
+    "Old East York (58)",
+    "Palmerston-Little Italy (80)",
+    "Parkwoods-O'Connor Hills (149)",
+    "Pelmo Park-Humberlea (23)",
+    "Playter Estates-Danforth (67)",
+    "Pleasant View (46)",
+    "Princess-Rosethorn (10)",
+    "Regent Park (72)",
+    "Rexdale-Kipling (4)",
+    "Rockcliffe-Smythe (111)",
+    "Roncesvalles (86)",
+    "Rosedale-Moore Park (98)",
+    "Runnymede-Bloor West Village (89)",
+    "Rustic (28)",
+    "Scarborough Village (139)",
+    "South Eglinton-Davisville (174)",
+    "South Parkdale (85)",
+    "South Riverdale (70)",
+    "St.Andrew-Windfields (40)",
+    "Steeles (116)",
+    "Stonegate-Queensway (16)",
+    "Tam O'Shanter-Sullivan (118)",
+    "Taylor-Massey (61)",
+    "The Beaches (63)",
+    "Thistletown-Beaumond Heights (3)",
+    "Thorncliffe Park (55)",
+    "Trinity-Bellwoods (81)",
+    "University (79)",
+    "Victoria Village (43)",
+    "Wellington Place (164)",
+    "West Hill (136)",
+    "West Humber-Clairville (1)",
+    "West Queen West (162)",
+    "West Rouge (143)",
+    "Westminster-Branson (35)",
+    "Weston (113)",
+    "Weston-Pelham Park (91)",
+    "Wexford/Maryvale (119)",
+    "Willowdale West (37)",
+    "Willowridge-Martingrove-Richview (7)",
+    "Woburn North (142)",
+    "Woodbine Corridor (64)",
+    "Woodbine-Lumsden (60)",
+    "Wychwood (94)",
+    "Yonge-Bay Corridor (170)",
+    "Yonge-Doris (151)",
+    "Yonge-Eglinton (100)",
+    "Yonge-St.Clair (97)",
+    "York University Heights (27)",
+    "Yorkdale-Glen Park (31)"
+]
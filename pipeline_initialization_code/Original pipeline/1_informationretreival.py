@@ -12,7 +12,7 @@ import subprocess
 import pkg_resources
 
 from dotenv import load_dotenv
-import json
+import orjson
 
 # Import Statements for writing/reading with Google Sheets API
 import requests
@@ -25,6 +25,7 @@ import html2text
 import PyPDF2
 import time
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import pytz
 
@@ -36,7 +37,14 @@ load_dotenv()
 
 # Variables:
 JSON_FILE = "torontopublicsafetycorpus.json"
-crawl_results = [] # store in json format
+# Results are written here while crawling, and only replace JSON_FILE if any URL was crawled
+PARTIAL_JSON_FILE = JSON_FILE + ".partial"
+
+# URLs crawled at once; FireCrawl rate limits per API key, and 429s are retried in crawl_with_retry
+CRAWL_WORKERS = 3
+
+# Wait time in FireCrawl's rate limit (429) error message
+WAIT_TIME_PATTERN = re.compile(r'retry after (\d+)s')
 
 
 # Some keys and JSON files for API Keys are hidden in this repo.
@@ -118,7 +126,7 @@ crawl_params = {
 
 def extract_wait_time(error_message):
     """Extract wait time from FireCrawl error message"""
-    wait_time_match = re.search(r'retry after (\d+)s', str(error_message))
+    wait_time_match = WAIT_TIME_PATTERN.search(str(error_message))
     if wait_time_match:
         return int(wait_time_match.group(1))
     return 60  # default wait time if we can't parse the message
@@ -148,17 +156,34 @@ def crawl_with_retry(app, link, max_retries=3):
                 print(f"Error crawling {link}: {str(e)}")
                 return None
 
-# Replace the crawling loop with this:
-for link in resources:
+def crawl_and_pause(link):
+    """Crawl one URL, then pause before the worker takes the next one."""
     result = crawl_with_retry(app, link)
-    if result is not None:
-        crawl_results.append(result)
-    time.sleep(5)  # Add a small delay between successful crawls
-
-# ------ Part 3: Write to JSON file  ------
-# Save the crawl results to a JSON file
-with open(JSON_FILE, 'w') as f:
-    # We will re-write it each time.
-    json.dump(crawl_results, f, indent=2)
-
-print("Data has been written to json file.")
+    time.sleep(5)  # Add a small delay between crawls
+    return result
+
+# Crawl CRAWL_WORKERS URLs at a time, keeping the results in sheet order.
+# Each result is written to the JSON array as it arrives instead of holding the whole corpus until the end.
+# The previous corpus is kept until the new one is complete, so a failed or interrupted crawl leaves it intact.
+crawled_count = 0
+try:
+    with open(PARTIAL_JSON_FILE, 'wb') as f, ThreadPoolExecutor(max_workers=CRAWL_WORKERS) as executor:
+        f.write(b'[')
+        for result in executor.map(crawl_and_pause, resources):
+            if result is not None:
+                f.write(b',\n' if crawled_count else b'\n')
+                f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
+                crawled_count += 1
+        f.write(b'\n]')
+except BaseException:
+    if os.path.exists(PARTIAL_JSON_FILE):
+        os.remove(PARTIAL_JSON_FILE)
+    raise
+
+# Save results only if we have any
+if crawled_count:
+    os.replace(PARTIAL_JSON_FILE, JSON_FILE)
+    print("Data has been written to json file.")
+else:
+    os.remove(PARTIAL_JSON_FILE)
+    print("No results were collected during crawling")
@@ -5,7 +5,10 @@ Goal: Filter out copyrighted domains from the existing corpus and save to a new
 
 import json
 import logging
-from urllib.parse import urlparse
+import ijson
+import os
+import re
+from functools import lru_cache
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(message)s')
@@ -15,6 +18,16 @@ logger = logging.getLogger(__name__)
 INPUT_JSON = "torontopublicsafetycorpus.json"
 OUTPUT_JSON = "non_copyrighted_torontopublicsafetycorpus.json"
 
+# Host part (netloc) of an absolute URL, the same text urlparse(url).netloc returns
+NETLOC_PATTERN = re.compile(r'[A-Za-z][A-Za-z0-9+.-]*://([^/?#]*)')
+
+@lru_cache(maxsize=None)
+def parse_domain(source_url: str):
+    """Domain and base domain (last two labels) of a URL, cached since many documents share a site."""
+    match = NETLOC_PATTERN.match(source_url)
+    domain = match.group(1).lower() if match else ''
+    return domain, '.'.join(domain.split('.')[-2:])
+
 def filter_corpus(input_file: str, output_file: str):
     """Filter out copyrighted domains and save to new JSON file."""
     
@@ -29,68 +42,60 @@ def filter_corpus(input_file: str, output_file: str):
         # 'torontopolice.on.ca'  # Keep TPS domain
     }
     
-    filtered_results = []
+    kept_batches = 0
     excluded_count = 0
     kept_domains = set()
     
+    # The filtered corpus is written here and only replaces output_file once complete,
+    # so a failed run leaves the previous corpus in place for ingestion
+    partial_file = output_file + ".partial"
+    
     try:
-        # Read original JSON
-        with open(input_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        # Stream batches from the original JSON and write each filtered batch straight out,
+        # so neither corpus is held in memory as a whole
+        with open(input_file, 'rb') as f, open(partial_file, 'w', encoding='utf-8') as out:
+            # All domains in the corpus, collected while filtering
+            all_domains = set()
+            
+            out.write('[')
+            # Process and filter in one pass
+            for batch in ijson.items(f, 'item', use_float=True):
+                filtered_batch = batch.copy()
+                filtered_items = []
+                
+                if 'data' in batch:
+                    for item in batch['data']:
+                        if 'metadata' in item:
+                            source_url = item['metadata'].get('sourceURL', 
+                                       item['metadata'].get('url', ''))
+                            
+                            try:
+                                domain, base_domain = parse_domain(source_url)
+                                all_domains.add(base_domain)
+                            except:
+                                domain = ''
+                                base_domain = ''
+                                
+                            if base_domain in excluded_domains:
+                                excluded_count += 1
+                                logger.info(f"Excluding document from: {domain} ({base_domain})")
+                                continue
+                                
+                            filtered_items.append(item)
+                            kept_domains.add(base_domain)
+                
+                if filtered_items:
+                    filtered_batch['data'] = filtered_items
+                    out.write(',\n' if kept_batches else '\n')
+                    out.write(json.dumps(filtered_batch, indent=2))
+                    kept_batches += 1
+            out.write('\n]')
+        os.replace(partial_file, output_file)
             
-        # First, let's see all domains in the corpus
-        all_domains = set()
-        for batch in data:
-            if 'data' in batch:
-                for item in batch['data']:
-                    if 'metadata' in item:
-                        source_url = item['metadata'].get('sourceURL', 
-                                   item['metadata'].get('url', ''))
-                        try:
-                            domain = urlparse(source_url).netloc.lower()
-                            base_domain = '.'.join(domain.split('.')[-2:])
-                            all_domains.add(base_domain)
-                        except:
-                            continue
-        
         logger.info("\nAll domains in corpus:")
         for domain in sorted(all_domains):
             logger.info(f"- {domain}")
             
-        # Now process and filter
-        for batch in data:
-            filtered_batch = batch.copy()
-            filtered_items = []
-            
-            if 'data' in batch:
-                for item in batch['data']:
-                    if 'metadata' in item:
-                        source_url = item['metadata'].get('sourceURL', 
-                                   item['metadata'].get('url', ''))
-                        
-                        try:
-                            domain = urlparse(source_url).netloc.lower()
-                            base_domain = '.'.join(domain.split('.')[-2:])
-                        except:
-                            domain = ''
-                            base_domain = ''
-                            
-                        if base_domain in excluded_domains:
-                            excluded_count += 1
-                            logger.info(f"Excluding document from: {domain} ({base_domain})")
-                            continue
-                            
-                        filtered_items.append(item)
-                        kept_domains.add(base_domain)
-            
-            if filtered_items:
-                filtered_batch['data'] = filtered_items
-                filtered_results.append(filtered_batch)
-            
-        # Save filtered results
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(filtered_results, f, indent=2)
-            
         logger.info(f"\nFiltering complete:")
         logger.info(f"- Excluded {excluded_count} documents")
         logger.info(f"\nKept domains:")
@@ -100,6 +105,8 @@ def filter_corpus(input_file: str, output_file: str):
         
     except Exception as e:
         logger.error(f"Error filtering corpus: {str(e)}")
+        if os.path.exists(partial_file):
+            os.remove(partial_file)
 
 if __name__ == "__main__":
     filter_corpus(INPUT_JSON, OUTPUT_JSON) 
\ No newline at end of file
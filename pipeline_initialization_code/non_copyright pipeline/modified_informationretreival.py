@@ -14,7 +14,7 @@ import subprocess
 import pkg_resources
 
 from dotenv import load_dotenv
-import json
+import orjson
 
 # Import Statements for writing/reading with Google Sheets API
 import requests
@@ -27,6 +27,7 @@ import html2text
 import PyPDF2
 import time
 import re
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import pytz
 
@@ -38,7 +39,14 @@ load_dotenv(".env", override=True)
 
 # Variables:
 JSON_FILE = "non_copyrighted_torontopublicsafetycorpus.json"
-crawl_results = [] # store in json format
+# Results are written here while crawling, and only replace JSON_FILE if any URL was crawled
+PARTIAL_JSON_FILE = JSON_FILE + ".partial"
+
+# URLs crawled at once; FireCrawl rate limits per API key, and 429s are retried in crawl_with_retry
+CRAWL_WORKERS = 3
+
+# Wait time in FireCrawl's rate limit (429) error message
+WAIT_TIME_PATTERN = re.compile(r'retry after (\d+)s')
 
 
 # Some keys and JSON files for API Keys are hidden in this repo.
@@ -132,7 +140,7 @@ crawl_params = {
 
 def extract_wait_time(error_message):
     """Extract wait time from FireCrawl error message"""
-    wait_time_match = re.search(r'retry after (\d+)s', str(error_message))
+    wait_time_match = WAIT_TIME_PATTERN.search(str(error_message))
     if wait_time_match:
         return int(wait_time_match.group(1))
     return 60
@@ -172,30 +180,48 @@ def crawl_with_retry(app, link, max_retries=3):
     
     return None
 
-# Main crawling loop with proper wait handling
-print(f"Starting to crawl {len(resources)} URLs...")
-for link in resources:
+def crawl_and_pause(link):
+    """Crawl one URL, then pause before the worker takes the next one."""
     print(f"\nStarting crawl for: {link}")
     result = crawl_with_retry(app, link)
-    
-    # Check for stop condition
     if result == "STOP_ALL":
-        print("Stopping all crawls due to insufficient credits")
-        break
-        
+        return result
     if result is not None:
-        crawl_results.append(result)
-        print(f"Successfully added results for: {link}")
         time.sleep(5)  # Small delay between successful crawls
     else:
-        print(f"Skipping {link} due to errors")
         time.sleep(2)  # Minimal delay after errors
+    return result
+
+# Main crawling loop, CRAWL_WORKERS URLs at a time with results kept in sheet order.
+# Each result is written to the JSON array as it arrives instead of holding the whole corpus until the end.
+print(f"Starting to crawl {len(resources)} URLs...")
+crawled_count = 0
+with open(PARTIAL_JSON_FILE, 'wb') as f, ThreadPoolExecutor(max_workers=CRAWL_WORKERS) as executor:
+    f.write(b'[')
+    futures = [executor.submit(crawl_and_pause, link) for link in resources]
+    for link, future in zip(resources, futures):
+        result = future.result()
+        
+        # Check for stop condition, URLs not started yet are cancelled
+        if result == "STOP_ALL":
+            print("Stopping all crawls due to insufficient credits")
+            executor.shutdown(cancel_futures=True)
+            break
+            
+        if result is not None:
+            f.write(b',\n' if crawled_count else b'\n')
+            f.write(orjson.dumps(result, option=orjson.OPT_INDENT_2))
+            crawled_count += 1
+            print(f"Successfully added results for: {link}")
+        else:
+            print(f"Skipping {link} due to errors")
+    f.write(b'\n]')
 
 # Save results only if we have any
-if crawl_results:
-    with open(JSON_FILE, 'w') as f:
-        json.dump(crawl_results, f, indent=2)
+if crawled_count:
+    os.replace(PARTIAL_JSON_FILE, JSON_FILE)
     print(f"\nData has been written to {JSON_FILE}")
-    print(f"Successfully crawled {len(crawl_results)} URLs")
+    print(f"Successfully crawled {crawled_count} URLs")
 else:
+    os.remove(PARTIAL_JSON_FILE)
     print("\nNo results were collected during crawling")
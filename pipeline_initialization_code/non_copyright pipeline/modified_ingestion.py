@@ -1,10 +1,28 @@
 """
 2_ingestion.py
 Goal: Ingest non-copyrighted data into Pinecone Vector Database 'torontopolice2'
+
+Run with --bge to build 'torontopolice2-bge', embedded with the local BGE-small model (384 dimensions).
+main.py uses that index for retrieval queries when PINECONE_BGE_INDEX_NAME is set.
+The index must be created in Pinecone with dimension 384 and cosine metric before ingesting.
+
+Run with --small to build 'torontopolice2-small', embedded with text-embedding-3-small truncated to 1024 dimensions.
+Create it in Pinecone with dimension 1024 first; main.py uses it with EMBEDDING_MODEL=text-embedding-3-small and EMBEDDING_DIMENSIONS=1024.
+
+Run with --faiss to save a local FAISS index of the same chunks to 'faiss_tps', embedded with EMBEDDING_MODEL and
+EMBEDDING_DIMENSIONS (as read by main.py, text-embedding-3-large by default) so the index matches the query embeddings.
+main.py searches it in process instead of Pinecone when FAISS_INDEX_PATH points to it, and refuses to load it with a
+different embedding model. Needs faiss-cpu.
+
+Any of these flags builds only the optional indexes; add --primary to also re-ingest 'torontopolice2' in the same run.
+Chunk ids are derived from the source URL and chunk position, so re-ingesting overwrites vectors instead of adding copies.
 """
 
+import hashlib
+import ijson
 import json
 import os
+import sys
 from dotenv import load_dotenv
 from langchain_openai import OpenAIEmbeddings 
 from langchain_pinecone import PineconeVectorStore
@@ -24,14 +42,26 @@ logger = logging.getLogger(__name__)
 PINECONE_INDEX = "torontopolice2"
 INPUT_FILE = "non_copyrighted_torontopublicsafetycorpus.json"
 
+# Index and model for smaller OpenAI embeddings
+SMALL_PINECONE_INDEX = "torontopolice2-small"
+SMALL_EMBEDDING_MODEL = "text-embedding-3-small"
+SMALL_EMBEDDING_DIMENSIONS = 1024
+
+# Index and model for local query embeddings
+BGE_PINECONE_INDEX = "torontopolice2-bge"
+BGE_MODEL_NAME = "BAAI/bge-small-en-v1.5"
+
+# Directory of the local FAISS index, and the file in it recording the embedding model it was built with
+FAISS_INDEX_DIR = "faiss_tps"
+FAISS_EMBEDDING_FILE = "embedding_model.json"
+
 def load_json_data(file_path: str):
     """Load and parse the JSON file into LangChain documents."""
     documents = []
     
-    with open(file_path, 'r', encoding='utf-8') as file:
-        data = json.load(file)
-        
-        for batch in data:
+    # Stream the batches one at a time instead of loading the whole corpus into memory first
+    with open(file_path, 'rb') as file:
+        for batch in ijson.items(file, 'item'):
             if 'data' in batch:
                 for item in batch['data']:
                     if 'markdown' in item and 'metadata' in item:
@@ -54,22 +84,29 @@ def load_json_data(file_path: str):
 
 def text_splitter(documents):
     """Split documents into smaller chunks."""
-    total_splits = []    
-    for doc in documents:
-        splitter = RecursiveCharacterTextSplitter(
-            separators=["\n\n", "\n", " ", ""],
-            chunk_size=1000,
-            chunk_overlap=200,
-            length_function=len,
-        )
-        
-        splits = splitter.split_documents([doc])
-        total_splits.extend(splits)
+    splitter = RecursiveCharacterTextSplitter(
+        separators=["\n\n", "\n", " ", ""],
+        chunk_size=1000,
+        chunk_overlap=200,
+        length_function=len,
+    )
+    total_splits = splitter.split_documents(documents)
     
     logger.info(f"Split into {len(total_splits)} chunks")
     return total_splits
 
-def main():
+def chunk_ids(chunks):
+    """Stable vector id per chunk: SHA-256 of its source URL and its position among that source's chunks."""
+    ids = []
+    positions = {}
+    for chunk in chunks:
+        source = chunk.metadata['source']
+        position = positions.get(source, 0)
+        positions[source] = position + 1
+        ids.append(hashlib.sha256(f"{source}\x00{position}".encode("utf-8")).hexdigest())
+    return ids
+
+def main(primary: bool = True, bge: bool = False, small: bool = False, faiss: bool = False):
     """Main function to process documents and load into Pinecone."""
     # Check for OpenAI API key
     if not os.getenv("OPENAI_API_KEY"):
@@ -84,20 +121,81 @@ def main():
     
     # Split text into chunks
     text_split_chunks = text_splitter(documents)
+    ids = chunk_ids(text_split_chunks)
     
-    logger.info(f"Ingesting documents into vector store index '{PINECONE_INDEX}'...")
     embeddings = OpenAIEmbeddings(model="text-embedding-3-large")
     
-    # Create vector store with hardcoded index name
-    vector_store = PineconeVectorStore.from_documents(
-        documents=text_split_chunks, 
-        embedding=embeddings, 
-        index_name=PINECONE_INDEX
-    )
-    logger.info(f"Document ingestion complete into index: {PINECONE_INDEX}")
+    if primary:
+        logger.info(f"Ingesting documents into vector store index '{PINECONE_INDEX}'...")
+        # Create vector store with hardcoded index name
+        vector_store = PineconeVectorStore.from_documents(
+            documents=text_split_chunks, 
+            embedding=embeddings, 
+            index_name=PINECONE_INDEX,
+            ids=ids
+        )
+        logger.info(f"Document ingestion complete into index: {PINECONE_INDEX}")
+    
+    if faiss:
+        # Imported here so the default ingestion does not need faiss installed
+        from langchain_community.vectorstores import FAISS
+        from langchain_community.vectorstores.utils import DistanceStrategy
+        
+        # Same model and dimensions main.py embeds queries with, so both live in one vector space
+        faiss_model = os.getenv("EMBEDDING_MODEL", "text-embedding-3-large")
+        faiss_dimensions = int(os.environ["EMBEDDING_DIMENSIONS"]) if os.getenv("EMBEDDING_DIMENSIONS") else None
+        
+        # Exact inner-product search; OpenAI embeddings are unit length, so this is cosine similarity as in Pinecone.
+        # The corpus is a few thousand chunks, so a flat index searches it in milliseconds
+        logger.info(f"Saving local FAISS index to '{FAISS_INDEX_DIR}' ({faiss_model})...")
+        faiss_store = FAISS.from_documents(
+            documents=text_split_chunks,
+            embedding=OpenAIEmbeddings(model=faiss_model, dimensions=faiss_dimensions),
+            ids=ids,
+            distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT
+        )
+        faiss_store.save_local(FAISS_INDEX_DIR)
+        with open(os.path.join(FAISS_INDEX_DIR, FAISS_EMBEDDING_FILE), 'w') as f:
+            json.dump({"model": faiss_model, "dimensions": faiss_dimensions}, f)
+        logger.info(f"Local FAISS index saved to: {FAISS_INDEX_DIR}")
+    
+    if small:
+        logger.info(f"Ingesting documents into vector store index '{SMALL_PINECONE_INDEX}'...")
+        small_embeddings = OpenAIEmbeddings(
+            model=SMALL_EMBEDDING_MODEL,
+            dimensions=SMALL_EMBEDDING_DIMENSIONS
+        )
+        PineconeVectorStore.from_documents(
+            documents=text_split_chunks,
+            embedding=small_embeddings,
+            index_name=SMALL_PINECONE_INDEX,
+            ids=ids
+        )
+        logger.info(f"Document ingestion complete into index: {SMALL_PINECONE_INDEX}")
+    
+    if bge:
+        # Imported here so the default ingestion does not need sentence-transformers installed
+        from langchain_huggingface import HuggingFaceEmbeddings
+        
+        logger.info(f"Ingesting documents into vector store index '{BGE_PINECONE_INDEX}'...")
+        bge_embeddings = HuggingFaceEmbeddings(
+            model_name=BGE_MODEL_NAME,
+            model_kwargs={"device": "cpu"},
+            encode_kwargs={"normalize_embeddings": True}
+        )
+        PineconeVectorStore.from_documents(
+            documents=text_split_chunks,
+            embedding=bge_embeddings,
+            index_name=BGE_PINECONE_INDEX,
+            ids=ids
+        )
+        logger.info(f"Document ingestion complete into index: {BGE_PINECONE_INDEX}")
 
 if __name__ == "__main__":
-    main()
+    bge, small, faiss = "--bge" in sys.argv, "--small" in sys.argv, "--faiss" in sys.argv
+    # The primary index is only rebuilt by default, or alongside the optional ones with --primary
+    primary = "--primary" in sys.argv or not (bge or small or faiss)
+    main(primary=primary, bge=bge, small=small, faiss=faiss)
 
 # Quick Math:
 # Documents = 236 - uniquely scraped
\ No newline at end of file
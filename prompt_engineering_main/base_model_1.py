@@ -26,22 +26,8 @@ from operator import itemgetter
 from dotenv import load_dotenv
 load_dotenv(".env", override=True)
 
-# Functions - Safety Plan Generation
-
-def generate_safety_plan(
-    neighbourhood: str,
-    crime_type: List[str],
-    user_context: List[str],
-    ):
-    
-    """
-    This code generates a safety plan based on specific neighbourhood and crime concerns.
-    
-    Chain of Thought is implemented, where the LLM is (1) Prompted to provide a detailed analysis considering only the information provided above, and (2) Prompted to provide a comprehensive and actionable safety plan that addresses the user's concerns and enhances their safety, in the City of Toronto.
-    """
-    
-    # Example Safety Plan
-    example_safety_plan = """
+# Example Safety Plan, defined once at import
+EXAMPLE_SAFETY_PLAN = """
     CITY OF TORONTO SERVICE SAFETY PLAN
     Neighbourhood: Agincourt North (129)
     Primary Concerns: Assault: Low, Auto Theft: Medium, Break and Enter: Low, Robbery: Medium
@@ -80,8 +66,8 @@ def generate_safety_plan(
   
     """
     
-    # Define the prompt template
-    FIRST_SAFETY_PROMPT = PromptTemplate.from_template("""
+# Define the prompt templates, compiled once at import
+FIRST_SAFETY_PROMPT = PromptTemplate.from_template("""
     You are a City of Toronto safety advisor specializing in crime prevention and public safety in Toronto, Ontario. 
     
     Your task is to provide a relevant, factual and meaningful analysis based on the user's request and the relevant resources.
@@ -102,7 +88,7 @@ def generate_safety_plan(
     Refrain from providing legal, medical, financial or personal or professional advice, stay within the scope of a safety plan and a role as a safety advisor.
     """)
     
-    SECOND_SAFETY_PROMPT = PromptTemplate.from_template("""You are a City of Toronto safety advisor specializing in crime prevention and public safety in Toronto, Ontario. 
+SECOND_SAFETY_PROMPT = PromptTemplate.from_template("""You are a City of Toronto safety advisor specializing in crime prevention and public safety in Toronto, Ontario. 
     
     Your goal is to synthesize the provided analysis into an actionable, tailored safety plan that supports the user's safety concerns and enhances their safety, in the City of Toronto. Your tone should be respectful and professional.
     
@@ -155,6 +141,20 @@ def generate_safety_plan(
 
     Remember: Focus on prevention and awareness without causing undue alarm. Empower the user with knowledge and practical steps they can take to enhance their safety.
     """)
+
+# Functions - Safety Plan Generation
+
+def generate_safety_plan(
+    neighbourhood: str,
+    crime_type: List[str],
+    user_context: List[str],
+    ):
+    
+    """
+    This code generates a safety plan based on specific neighbourhood and crime concerns.
+    
+    Chain of Thought is implemented, where the LLM is (1) Prompted to provide a detailed analysis considering only the information provided above, and (2) Prompted to provide a comprehensive and actionable safety plan that addresses the user's concerns and enhances their safety, in the City of Toronto.
+    """
     
     # Format the crime concerns for the prompt
     formatted_crime_concerns = ", ".join(crime_type)
@@ -190,7 +190,7 @@ def generate_safety_plan(
         {
             "input": itemgetter("input"),
             "analysis": itemgetter("answer"),
-            "example_safety_plan": lambda _: example_safety_plan,
+            "example_safety_plan": lambda _: EXAMPLE_SAFETY_PLAN,
             "context": itemgetter("context")
         } | 
         {
@@ -207,10 +207,10 @@ def generate_safety_plan(
             {x["plan"]}
 
             Sources Consulted:
-            {chr(10).join([f"- {title} ({source})" for title, source in {
+            {chr(10).join([f"- {title} ({source})" for title, source in dict.fromkeys(
                 (doc.metadata.get('title', 'Untitled'), doc.metadata['source'])
                 for doc in x["context"]
-            }])}
+            )])}
             
             ----
             